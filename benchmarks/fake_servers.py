@@ -0,0 +1,239 @@
+"""
+本地模拟的推特filtered stream、图片服务器和B站动态/评论/上传接口，用于离线压测
+"""
+import io
+import json
+import time
+import random
+import asyncio
+import itertools
+from urllib.parse import urlsplit
+from aiohttp import web
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from typing import Dict, List, Optional, Tuple
+
+
+# 可以生成的推文类型，multi_photo为带多张图片的原创推文
+TWEET_KINDS = ('original', 'quoted', 'replied_to', 'multi_photo')
+
+
+class FakeTwitter:
+    """
+    模拟filtered stream：按设定速率推送推文，空闲时发送'\\r\\n'保活。
+    推文类型按mix中的权重随机生成，emitted记录每条推文的推送时间
+    """
+
+    def __init__(self, usernames: List[str], media_base_url: str, total: int = 100,
+                 rate: float = 10, mix: Optional[Dict[str, float]] = None,
+                 max_photos: int = 4, keep_alive_interval: float = 1) -> None:
+        self.usernames = usernames
+        self.media_base_url = media_base_url
+        self.total = total
+        self.rate = rate
+        self.mix = mix if mix is not None else {
+            'original': 0.4, 'quoted': 0.2, 'replied_to': 0.3, 'multi_photo': 0.1}
+        self.max_photos = max_photos
+        self.keep_alive_interval = keep_alive_interval
+
+        self.emitted: Dict[str, float] = {}
+        self._ids = itertools.count(1000)
+        self._tweets: List[Dict] = []
+        self._rule_ids = itertools.count(1)
+
+    def _user(self, username: str) -> Dict:
+        return {'id': 'u_' + username, 'username': username, 'name': username}
+
+    def _media(self, n: int) -> List[Dict]:
+        return [{'media_key': f'm_{next(self._ids)}', 'type': 'photo',
+                 'url': f'{self.media_base_url}/media/{random.randrange(1000)}.jpg'} for _ in range(n)]
+
+    def make_payload(self) -> Dict:
+        kind = random.choices(list(self.mix), weights=list(self.mix.values()))[0]
+        username = random.choice(self.usernames)
+        tweet = {
+            'id': str(next(self._ids)), 'author_id': 'u_' + username,
+            'text': f'{kind} tweet from {username} ' + 'text ' * random.randrange(5, 40),
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())}
+        includes = {'users': [self._user(username)], 'tweets': [], 'media': []}
+
+        if kind in ('quoted', 'replied_to') and self._tweets:
+            parent = random.choice(self._tweets[-20:])
+            tweet['referenced_tweets'] = [{'type': kind, 'id': parent['id']}]
+            includes['tweets'].append({key: value for key, value in parent.items() if key != '_media'})
+            includes['users'].append(self._user(parent['author_id'][2:]))
+            includes['media'].extend(parent['_media'])
+
+        photos = self._media(random.randint(2, self.max_photos) if kind == 'multi_photo'
+                             else random.choice([0, 0, 1]))
+        if photos:
+            tweet['attachments'] = {'media_keys': [m['media_key'] for m in photos]}
+            includes['media'].extend(photos)
+        self._tweets.append(dict(tweet, _media=photos))
+        return {'data': tweet, 'includes': includes}
+
+    async def stream(self, request: web.Request) -> web.StreamResponse:
+        response = web.StreamResponse()
+        await response.prepare(request)
+        last_write = time.monotonic()
+        try:
+            while len(self.emitted) < self.total:
+                payload = self.make_payload()
+                self.emitted[payload['data']['id']] = time.monotonic()
+                await response.write(json.dumps(payload).encode() + b'\r\n')
+                last_write = time.monotonic()
+                await asyncio.sleep(random.expovariate(self.rate))
+            while True:
+                await asyncio.sleep(max(0.0, self.keep_alive_interval - (time.monotonic() - last_write)))
+                await response.write(b'\r\n')
+                last_write = time.monotonic()
+        except ConnectionResetError:
+            return response
+
+    async def get_rules(self, request: web.Request) -> web.Response:
+        return web.json_response({'data': []})
+
+    async def set_rules(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        rules = [dict(rule, id=str(next(self._rule_ids))) for rule in payload.get('add', [])]
+        return web.json_response({'data': rules, 'meta': {'sent': ''}})
+
+    async def tweet_lookup(self, request: web.Request) -> web.Response:
+        return web.json_response({'data': {'id': request.match_info['id'], 'text': ''}, 'includes': {}})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/2/tweets/search/stream', self.stream)
+        app.router.add_get('/2/tweets/search/stream/rules', self.get_rules)
+        app.router.add_post('/2/tweets/search/stream/rules', self.set_rules)
+        app.router.add_get('/2/tweets/{id}', self.tweet_lookup)
+        return app
+
+
+class FakeMediaHost:
+    """
+    图片服务器。指定dimensions且安装了Pillow时返回该尺寸的噪点JPEG（接近相机原图的压缩率），
+    否则返回size字节的随机数据
+    """
+
+    def __init__(self, size: int = 200 << 10, latency: float = 0.05,
+                 dimensions: Optional[Tuple[int, int]] = None) -> None:
+        self.size = size
+        self.latency = latency
+        self.requests = 0
+        self._image: Optional[bytes] = None
+        if dimensions is not None and Image is not None:
+            buffer = io.BytesIO()
+            Image.effect_noise(dimensions, 30).convert('RGB').save(buffer, format='JPEG', quality=95)
+            self._image = buffer.getvalue()
+
+    async def media(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        if self._image is not None:
+            # JPEG结束标记之后追加路径，不同链接的图片内容不同，同一链接的相同
+            body = self._image + request.path.encode()
+        else:
+            body = random.randbytes(self.size)
+        return web.Response(body=body, content_type='image/jpeg')
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/media/{name}', self.media)
+        return app
+
+
+class FakeBilibili:
+    """
+    模拟B站动态、评论和图片上传接口。latency为每个接口的延迟（秒），
+    error_codes为错误码 -> 返回该错误的概率
+    """
+
+    def __init__(self, latency: Optional[Dict[str, float]] = None,
+                 error_codes: Optional[Dict[int, float]] = None) -> None:
+        self.latency = {'upload': 0.2, 'dynamic': 0.1, 'comment': 0.1, 'repost': 0.1, 'detail': 0.05}
+        if latency is not None:
+            self.latency.update(latency)
+        self.error_codes = error_codes if error_codes is not None else {}
+
+        self.calls: Dict[str, int] = {action: 0 for action in self.latency}
+        self.uploaded_bytes = 0
+        self._ids = itertools.count(10 ** 15)
+        self._dynamics: Dict[int, Dict] = {}
+
+    async def _reply(self, action: str, data: Dict) -> web.Response:
+        self.calls[action] += 1
+        await asyncio.sleep(self.latency[action])
+        for code, probability in self.error_codes.items():
+            if random.random() < probability:
+                return web.json_response({'code': code, 'message': 'injected error'})
+        return web.json_response({'code': 0, 'message': '0', 'data': data})
+
+    async def upload(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        self.uploaded_bytes += len(form['file_up'].file.read())
+        n = next(self._ids)
+        return await self._reply('upload', {
+            'image_url': f'https://i0.hdslb.com/bfs/album/{n}.jpg', 'image_width': 1200, 'image_height': 900})
+
+    async def create(self, request: web.Request) -> web.Response:
+        dynamic_id = next(self._ids)
+        self._dynamics[dynamic_id] = {'type': 4, 'rid': dynamic_id}
+        return await self._reply('dynamic', {'dynamic_id': dynamic_id, 'dynamic_id_str': str(dynamic_id)})
+
+    async def create_draw(self, request: web.Request) -> web.Response:
+        dynamic_id, doc_id = next(self._ids), next(self._ids)
+        self._dynamics[dynamic_id] = {'type': 2, 'rid': doc_id}
+        return await self._reply('dynamic', {'dynamic_id': dynamic_id, 'doc_id': doc_id})
+
+    async def detail(self, request: web.Request) -> web.Response:
+        dynamic_id = int(request.query['dynamic_id'])
+        desc = self._dynamics.get(dynamic_id, {'type': 4, 'rid': dynamic_id})
+        return await self._reply('detail', {'card': {'desc': desc, 'card': '{}', 'extend_json': '{}'}})
+
+    async def repost(self, request: web.Request) -> web.Response:
+        return await self._reply('repost', {})
+
+    async def comment(self, request: web.Request) -> web.Response:
+        return await self._reply('comment', {'rpid': next(self._ids)})
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 << 20)
+        app.router.add_post('/api/v1/drawImage/upload', self.upload)
+        app.router.add_post('/dynamic_svr/v1/dynamic_svr/create', self.create)
+        app.router.add_post('/dynamic_svr/v1/dynamic_svr/create_draw', self.create_draw)
+        app.router.add_get('/dynamic_svr/v1/dynamic_svr/get_dynamic_detail', self.detail)
+        app.router.add_post('/dynamic_repost/v1/dynamic_repost/repost', self.repost)
+        app.router.add_post('/x/v2/reply/add', self.comment)
+        return app
+
+
+def redirect_bilibili_api(base_url: str):
+    """
+    将bilibili_api中动态和评论相关接口的域名替换为本地模拟服务器
+    """
+    from bilibili_api import comment, dynamic
+
+    def redirect(node):
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if key == 'url' and isinstance(value, str):
+                    node[key] = base_url + urlsplit(value).path
+                else:
+                    redirect(value)
+
+    redirect(dynamic.API)
+    redirect(comment.API)
+
+
+async def start_app(app: web.Application, host: str = '127.0.0.1', port: int = 0):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f'http://{host}:{port}'
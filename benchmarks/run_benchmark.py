@@ -0,0 +1,185 @@
+"""
+离线端到端压测：在本地启动模拟的推特stream、图片服务器和B站接口，让T2BForwarder完整地跑一遍，
+统计从stream推送到handler处理完成的延迟分位数、吞吐量和内存峰值
+
+    python -m benchmarks.run_benchmark --tweets 200 --rate 20 --error-code -509:0.05
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import resource
+import tempfile
+import tracemalloc
+from types import SimpleNamespace
+from loguru import logger
+
+from twitter2bilibili import T2BForwarder
+
+from .fake_servers import TWEET_KINDS, FakeBilibili, FakeMediaHost, FakeTwitter, redirect_bilibili_api, start_app
+
+from typing import Dict, List
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def parse_mapping(items: List[str], key_type=str) -> Dict:
+    mapping = {}
+    for item in items:
+        key, value = item.rsplit(':', 1)
+        mapping[key_type(key)] = float(value)
+    return mapping
+
+
+def make_config(workdir: str, usernames: List[str], args) -> SimpleNamespace:
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    # 订阅用户轮流分到各个账号
+    accounts = ['default'] + [f'account{i}' for i in range(1, args.accounts)]
+    return SimpleNamespace(
+        BILI_SESSDATA='bench', BILI_BILI_JCT='bench', BILI_DEDE='bench',
+        TWITTER_BEARER_TOKEN='bench',
+        subscribe_users=[{'username': name, 'name': name, 'account': accounts[i % len(accounts)]}
+                         for i, name in enumerate(usernames)],
+        bili_accounts={account: {'sessdata': account, 'bili_jct': account, 'dedeuserid': account}
+                       for account in accounts[1:]},
+        display_timezone='Asia/Shanghai',
+        gap_img=os.path.join(repo_root, 'gap_img.png'),
+        forward_info_path=os.path.join(workdir, 'forward_info.jsonl'),
+        outbox_path=os.path.join(workdir, 'outbox.jsonl'),
+        media_cache_dir=os.path.join(workdir, 'media_cache'),
+        learned_words_path=os.path.join(workdir, 'learned_words.json'),
+        backfill_state_path=os.path.join(workdir, 'backfill_state.json'),
+        uploaded_images_path=os.path.join(workdir, 'uploaded_images.jsonl'),
+        queue_workers=args.workers, send_rate=args.send_rate, send_burst=args.send_burst,
+        metrics_port=args.metrics_port, image_max_dimension=args.image_max_dimension or None,
+        comment_coalesce_window=args.comment_coalesce_window, trace_path=args.trace_path)
+
+
+async def run(args) -> Dict:
+    usernames = [f'member{i}' for i in range(args.users)]
+    dimensions = tuple(map(int, args.photo_dimensions.split('x'))) if args.photo_dimensions else None
+    media_host = FakeMediaHost(size=args.photo_bytes, latency=args.media_latency, dimensions=dimensions)
+    bilibili = FakeBilibili(latency=parse_mapping(args.bili_latency),
+                            error_codes=parse_mapping(args.error_code, int))
+
+    media_runner, media_url = await start_app(media_host.app())
+    twitter = FakeTwitter(usernames, media_url, total=args.tweets, rate=args.rate,
+                          mix=args.mix)
+    twitter_runner, twitter_url = await start_app(twitter.app())
+    bili_runner, bili_url = await start_app(bilibili.app())
+    redirect_bilibili_api(bili_url)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        forwarder = T2BForwarder(make_config(workdir, usernames, args))
+        forwarder.api.STREAM_URL = twitter_url + '/2/tweets/search/stream'
+        forwarder.api.STREAM_RULES_URL = twitter_url + '/2/tweets/search/stream/rules'
+        forwarder.api.TWEET_LOOKUP_BASE_URL = twitter_url + '/2/tweets/'
+
+        latencies: List[float] = []
+        done = asyncio.Event()
+        handler = forwarder.queue.handler
+
+        async def timed_handler(tweet):
+            await handler(tweet)
+            latencies.append(time.monotonic() - twitter.emitted[tweet.id])
+            if len(latencies) >= args.tweets:
+                done.set()
+        forwarder.queue.handler = timed_handler
+
+        start = time.monotonic()
+        task = asyncio.ensure_future(forwarder._run())
+        try:
+            await asyncio.wait_for(done.wait(), args.timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f'Benchmark timed out, {len(latencies)}/{args.tweets} tweets handled')
+        elapsed = time.monotonic() - start
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        forwarder.close()
+
+    for runner in (twitter_runner, media_runner, bili_runner):
+        await runner.cleanup()
+
+    return {
+        'tweets': len(latencies),
+        'elapsed_seconds': round(elapsed, 3),
+        'tweets_per_second': round(len(latencies) / elapsed, 2),
+        'latency_p50_seconds': round(percentile(latencies, 50), 3),
+        'latency_p99_seconds': round(percentile(latencies, 99), 3),
+        'latency_max_seconds': round(max(latencies, default=float('nan')), 3),
+        'media_requests': media_host.requests,
+        'bilibili_calls': bilibili.calls,
+        'uploaded_bytes': bilibili.uploaded_bytes,
+        'image_uploads': forwarder.sender.upload_stats,
+        'image_processor': forwarder.image_processor.stats if forwarder.image_processor is not None else None,
+        'queue': forwarder.queue.stats,
+        'comment_coalescer': forwarder.coalescer.stats if forwarder.coalescer is not None else None,
+        'startup': forwarder.startup.report(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tweets', type=int, default=100, help='推送的推文总数')
+    parser.add_argument('--rate', type=float, default=10, help='平均每秒推送的推文数')
+    parser.add_argument('--users', type=int, default=10, help='订阅的用户数')
+    parser.add_argument('--accounts', type=int, default=1, help='B站账号数，每个账号有独立的发送限速')
+    parser.add_argument('--workers', type=int, default=4, help='转发队列的worker数')
+    parser.add_argument('--photo-bytes', type=int, default=200 << 10,
+                        help='每张图片的字节数（没有安装Pillow或--photo-dimensions为空时使用）')
+    parser.add_argument('--photo-dimensions', default='1600x1200', metavar='WIDTHxHEIGHT',
+                        help='图片尺寸，安装了Pillow时返回该尺寸的JPEG')
+    parser.add_argument('--image-max-dimension', type=int, default=2048,
+                        help='上传前图片最长边的上限，0为不处理图片')
+    parser.add_argument('--media-latency', type=float, default=0.05, help='图片服务器延迟（秒）')
+    parser.add_argument('--mix', default=None, metavar='KIND:WEIGHT,...',
+                        help=f'推文类型的权重，如original:0.4,quoted:0.2,replied_to:0.3,multi_photo:0.1，'
+                             f'KIND为{"/".join(TWEET_KINDS)}')
+    parser.add_argument('--bili-latency', action='append', default=[], metavar='ACTION:SECONDS',
+                        help='B站接口延迟，ACTION为upload/dynamic/comment/repost/detail')
+    parser.add_argument('--error-code', action='append', default=[], metavar='CODE:PROBABILITY',
+                        help='B站接口以一定概率返回的错误码')
+    parser.add_argument('--send-rate', type=float, default=100, help='发送调度器的初始速率')
+    parser.add_argument('--send-burst', type=int, default=20, help='发送调度器的突发数')
+    parser.add_argument('--comment-coalesce-window', type=float, default=None,
+                        help='合并同一动态的回复的时间窗口（秒）')
+    parser.add_argument('--metrics-port', type=int, default=None, help='运行时输出指标的端口')
+    parser.add_argument('--trace-path', default=None, help='把每条推文的trace写入此文件（JSON Lines）')
+    parser.add_argument('--timeout', type=float, default=300, help='最长运行时间（秒）')
+    parser.add_argument('--tracemalloc', action='store_true', help='统计Python对象内存峰值（会拖慢运行）')
+    parser.add_argument('--verbose', action='store_true', help='输出转发日志')
+    args = parser.parse_args()
+    if args.mix:
+        try:
+            mix = parse_mapping(args.mix.split(','))
+        except ValueError:
+            parser.error(f'invalid --mix {args.mix!r}')
+        unknown = set(mix) - set(TWEET_KINDS)
+        if unknown:
+            parser.error(f'unknown tweet kinds in --mix: {", ".join(sorted(unknown))}')
+        if sum(mix.values()) <= 0:
+            parser.error('--mix needs a positive weight')
+        args.mix = mix
+
+    logger.remove()
+    logger.add(sys.stderr, level='DEBUG' if args.verbose else 'WARNING')
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    report = asyncio.get_event_loop().run_until_complete(run(args))
+
+    report['peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    if args.tracemalloc:
+        report['tracemalloc_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / (1 << 20), 1)
+    for key, value in report.items():
+        print(f'{key}: {value}')
+
+
+if __name__ == '__main__':
+    main()
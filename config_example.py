@@ -6,7 +6,7 @@ BILI_DEDE = 'xxx'
 # Twitter API
 TWITTER_BEARER_TOKEN = 'xxx'
 
-# 转推的用户
+# 转推的用户，可以用'account'指定转发到bili_accounts中的哪个账号，不指定时用上面的账号
 subscribe_users = [
     {'username': 'revuestarlight', 'name': '少女歌剧 Revue Starlight 官推'},
     {'username': 'koyamamomoyo', 'name': '小山百代'},
@@ -22,4 +22,99 @@ subscribe_users = [
 
 display_timezone = 'Asia/Shanghai'
 
-gap_img = 'gap_img.png'
\ No newline at end of file
+gap_img = 'gap_img.png'
+
+# 转发记录存储，可选'jsonl'（追加写日志）或'sqlite'
+forward_info_store = 'jsonl'
+forward_info_path = 'forward_info.jsonl'
+
+# 转发队列：容量、并行worker数、队列满时最多阻塞读stream的秒数（超时则丢弃推文）
+queue_size = 100
+queue_workers = 4
+queue_put_timeout = 10
+
+# 图片下载：内存/磁盘缓存字节数上限、缓存目录、全局并发数、单张图片大小上限
+media_cache_memory_bytes = 64 << 20
+media_cache_disk_bytes = 512 << 20
+media_cache_dir = 'media_cache'
+media_max_concurrency = 8
+media_max_bytes = 20 << 20
+
+# B站发送限速：初始速率（次/秒，会根据限流返回自动调整）、突发数、被限流后的最大重试次数
+send_rate = 0.5
+send_burst = 3
+send_max_retries = 5
+
+# 未处理完的推文记录，重启后重放
+outbox_path = 'outbox.jsonl'
+
+# 额外的违禁词表（JSON，词 -> 替换文本），以及被B站拒绝后学到的违禁词的保存位置
+illegal_words_path = None
+learned_words_path = 'learned_words.json'
+
+# 设置端口后在http://127.0.0.1:<端口>/metrics输出Prometheus格式的运行指标，None为关闭
+metrics_port = None
+
+# filtered stream规则的长度和数量上限，取决于推特API的访问级别
+rule_max_length = 512
+rule_max_count = 5
+
+# 修改本文件后自动重新加载订阅用户和显示设置的检查间隔（秒），None为只在收到SIGHUP时重新加载
+config_watch_interval = None
+
+# filtered stream超过这么多秒没有收到数据或keep alive信号就认为连接已卡死并重连（推特约20秒发送一次keep alive）
+stream_stall_timeout = 60
+
+
+# 记录每个订阅用户最后收到的推文，stream重连后用recent search补抓断线期间的推文（只能补最近7天），None为不补抓
+backfill_state_path = 'backfill_state.json'
+# 每组用户补抓时最多翻的页数（每页100条）
+backfill_max_pages = 5
+
+# 各类HTTP流量的连接池设置，会覆盖默认值。池名为stream、media、twitter-api，
+# 可设置limit、limit_per_host、ttl_dns_cache、keepalive_timeout（None为不复用连接）和timeout（秒）
+http_pools = {
+    # 'media': {'limit': 32, 'limit_per_host': 16, 'timeout': 120},
+}
+
+# 上传前缩小、重新压缩图片并去掉元数据（需要安装Pillow）：最长边像素数（None为不处理）、JPEG质量、单张体积上限、处理进程数
+image_max_dimension = 2048
+image_quality = 85
+image_max_bytes = 10 << 20
+image_workers = 2
+
+# 上传过的图片（按内容哈希）及B站返回的图片地址，相同的图片不再重复上传；None为不缓存。记录在最后一次使用若干天后淘汰
+uploaded_images_path = 'uploaded_images.jsonl'
+uploaded_images_valid_days = 30
+
+# 回复或引用的推文还在转发中时，最多等它多少秒（超时则按父推文没有转发处理）
+parent_wait_timeout = 60
+
+# 同一动态在这么多秒内收到的多条回复合并成尽量少的评论发出（每条不超过comment_max_length字），None为不合并
+comment_coalesce_window = None
+comment_max_length = 1000
+
+# 其他B站账号：账号名 -> 凭据，subscribe_users中用{'account': 账号名}指定。每个账号有独立的发送限速（可单独设置
+# send_rate、send_burst、send_max_retries）和转发记录（forward_info_path的扩展名前加上账号名），修改后需要重启
+bili_accounts = {
+    # 'sub': {'sessdata': 'xxx', 'bili_jct': 'xxx', 'dedeuserid': 'xxx', 'send_rate': 0.5},
+}
+
+# 把filtered stream收到的原始数据录制到此目录（gzip压缩的JSON Lines），可用python -m twitter2bilibili.replay重放；None为不录制
+stream_capture_dir = None
+stream_capture_max_bytes = 64 << 20
+stream_capture_max_files = 20
+
+# 重复推送的推文去重：记住最近的多少条推文id、超过多少秒后忘记（None为只按数量），以及是否再查转发记录
+dedupe_max_size = 10000
+dedupe_window = None
+dedupe_check_forward_store = True
+
+# 每条推文的处理过程（各步骤耗时、图片字节数、B站接口调用）以JSON Lines写入此文件，None为不记录；只记录其中trace_sample_rate比例的推文
+trace_path = None
+trace_sample_rate = 1.0
+
+# kill -USR1开始或停止事件循环的采样分析，结果（折叠栈格式，可用flamegraph.pl或speedscope查看）写入profile_dir
+profile_dir = 'profiles'
+profile_interval = 0.005
+profile_max_seconds = 60
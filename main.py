@@ -3,7 +3,10 @@ from twitter2bilibili import T2BForwarder
 
 from loguru import logger
 
-logger.add('t2b.log')
 
-forwarder = T2BForwarder(config)
-forwarder.run()
+# 图片处理的进程池以forkserver/spawn启动子进程，子进程会重新导入本模块，不能在导入时启动
+if __name__ == '__main__':
+    logger.add('t2b.log')
+
+    forwarder = T2BForwarder(config)
+    forwarder.run()
@@ -1,4 +1,29 @@
-from .forwarder import T2BForwarder
-from .listener import TwitterListener
-from .sender import BiliSender
-from .tweet import Tweet, TwitterUser, TwitterMedia
\ No newline at end of file
+"""
+包中的类在第一次访问时才导入所在的模块，import twitter2bilibili不会导入bilibili_api等依赖
+"""
+from .startup import import_module
+
+_EXPORTS = {
+    'T2BForwarder': 'forwarder',
+    'TwitterListener': 'listener',
+    'BiliSender': 'sender',
+    'Tweet': 'tweet',
+    'TwitterUser': 'tweet',
+    'TwitterMedia': 'tweet',
+    'TweetIncludes': 'tweet',
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name: str):
+    module = _EXPORTS.get(name, None)
+    if module is None:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(import_module(f'.{module}', __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,80 @@
+import os
+
+from .forward_store import TTLStore
+
+from typing import Callable, Optional, Tuple, TYPE_CHECKING
+if TYPE_CHECKING:
+    from .coalescer import CommentCoalescer
+    from .scheduler import SendScheduler
+    from .sender import BiliSender
+
+
+DEFAULT_ACCOUNT = 'default'
+
+BiliComponents = Tuple['BiliSender', 'SendScheduler', Optional['CommentCoalescer']]
+
+
+def account_path(path: str, account: str) -> str:
+    """
+    默认账号沿用原来的文件，其他账号在扩展名前加上账号名，如forward_info.sub.jsonl
+    """
+    if account == DEFAULT_ACCOUNT:
+        return path
+    root, extension = os.path.splitext(path)
+    return f'{root}.{account}{extension}'
+
+
+class BiliAccount:
+    """
+    一个B站账号的发送器、发送调度（独立的限速和队列）、评论合并和转发记录。
+    转发记录按账号分开，引用和回复只会关联到同一账号发出的动态。
+    发送器等组件需要导入bilibili_api，由components在第一次用到时（或load时）创建
+    """
+
+    def __init__(self, name: str, forward_store: TTLStore,
+                 components: Callable[[], BiliComponents]) -> None:
+        self.name = name
+        self.forward_store = forward_store
+        self._components = components
+        self._sender: Optional['BiliSender'] = None
+        self._scheduler: Optional['SendScheduler'] = None
+        self._coalescer: Optional['CommentCoalescer'] = None
+        self.loaded = False
+
+    def __repr__(self) -> str:
+        return f'BiliAccount({self.name!r})'
+
+    def load(self):
+        if not self.loaded:
+            self._sender, self._scheduler, self._coalescer = self._components()
+            self.loaded = True
+
+    @property
+    def sender(self) -> 'BiliSender':
+        self.load()
+        return self._sender
+
+    @sender.setter
+    def sender(self, sender: 'BiliSender'):
+        self.load()
+        self._sender = sender
+
+    @property
+    def scheduler(self) -> 'SendScheduler':
+        self.load()
+        return self._scheduler
+
+    @property
+    def coalescer(self) -> Optional['CommentCoalescer']:
+        self.load()
+        return self._coalescer
+
+    async def stop(self):
+        if self.loaded:
+            if self._coalescer is not None:
+                await self._coalescer.close()
+            await self._scheduler.stop()
+        await self.forward_store.stop()
+
+    def close(self):
+        self.forward_store.close()
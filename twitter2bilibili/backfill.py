@@ -0,0 +1,227 @@
+import os
+import json
+import time
+import asyncio
+from loguru import logger
+
+from .metrics import metrics
+from .rules import make_rule_value, pack_usernames
+from .tweet import Tweet, TweetIncludes
+from .twitter_api import TwitterAPI, TwitterAPIException
+
+from typing import Callable, Coroutine, Dict, List, Optional, TYPE_CHECKING
+if TYPE_CHECKING:
+    from .listener import TwitterListener
+
+
+# 推文id的高位是毫秒时间戳（snowflake），用来把时间换算成since_id
+TWITTER_EPOCH_MS = 1288834974657
+
+# recent search能搜到的时间范围，留出一分钟余量
+RECENT_SEARCH_WINDOW = 7 * 24 * 3600 - 60
+
+
+def snowflake_at(timestamp: float) -> int:
+    """
+    该时刻之前发出的推文的id都小于返回值
+    """
+    return (int(timestamp * 1000) - TWITTER_EPOCH_MS) << 22
+
+
+class BackfillIncomplete(Exception):
+    pass
+
+
+class Backfiller:
+    """
+    补抓stream断线期间错过的推文。
+
+    记录每个订阅用户最后收到的推文id并持久化，stream（重新）连上后，
+    把有记录的用户装箱成recent search查询分页拉取，再按各用户自己的记录过滤，
+    按推文id（即时间）顺序交给与stream相同的处理函数，已经收到过的推文（seen）不再交出。
+
+    stream断开前收到的最新推文之前的推文都已经收到过，所以每组的since_id取组内最早的记录，
+    但不早于断开前收到的最新推文，一个很久没发推的用户不会把整组的搜索范围拉长。
+    recent search只能搜到最近7天的推文，剩余次数用完时等到限额重置
+    """
+
+    def __init__(self, api: TwitterAPI, listener: 'TwitterListener',
+                 state_path: Optional[str] = 'backfill_state.json', max_query_length: int = 512,
+                 max_pages: int = 5, save_interval: float = 60, max_rate_limit_wait: float = 900,
+                 seen: Optional[Callable[[str], bool]] = None) -> None:
+        self.api = api
+        self.listener = listener
+        self.state_path = state_path
+        self.max_query_length = max_query_length
+        self.max_pages = max_pages
+        self.save_interval = save_interval
+        self.max_rate_limit_wait = max_rate_limit_wait
+        self.seen = seen
+
+        self.last_seen: Dict[str, str] = {}
+        if state_path is not None and os.path.exists(state_path):
+            with open(state_path, 'r', encoding='utf-8') as f:
+                self.last_seen = json.load(f)
+        # stream收到的最新推文id，断线期间的推文都比它新
+        self.newest_id: Optional[int] = max(map(int, self.last_seen.values()), default=None)
+        self._dirty = False
+        self._last_save = time.monotonic()
+        self._task: Optional[asyncio.Task] = None
+
+        self.stats = {'runs': 0, 'requests': 0, 'backfilled': 0}
+
+    def record(self, tweet: Tweet):
+        """
+        记录收到的推文，更新作者最后收到的推文id
+        """
+        author = tweet.author
+        if author is not None and author.username in self.listener.subscribe_users:
+            last_id = self.last_seen.get(author.username, None)
+            if last_id is None or int(tweet.id) > int(last_id):
+                self.last_seen[author.username] = tweet.id
+                self.newest_id = max(int(tweet.id), self.newest_id or 0)
+                self._dirty = True
+                if time.monotonic() - self._last_save > self.save_interval:
+                    self.save()
+
+    def save(self):
+        self._last_save = time.monotonic()
+        if self.state_path is None or not self._dirty:
+            return
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.last_seen, f)
+        os.replace(tmp_path, self.state_path)
+        self._dirty = False
+
+    def start(self, handler: Callable[[Tweet], Coroutine], query: Dict):
+        """
+        在后台开始补抓，上一次补抓还没结束时不重复开始
+        """
+        if self._task is not None and not self._task.done():
+            return
+        # 在stream推来新的推文之前取快照
+        self._task = asyncio.ensure_future(self.backfill(handler, query, dict(self.last_seen), self.newest_id))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self.save()
+
+    async def _wait_rate_limit(self, url: str):
+        remaining, reset = self.api.rate_limits.get(url, (1, 0))
+        if remaining > 0:
+            return
+        wait = reset - time.time()
+        if wait > self.max_rate_limit_wait:
+            raise TwitterAPIException(429, {'detail': f'rate limit resets in {wait:.0f}s'})
+        if wait > 0:
+            logger.info(f'Backfill waits {wait:.0f}s for rate limit reset')
+            await asyncio.sleep(wait)
+
+    async def _search(self, usernames: List[str], since_id: str, query: Dict) -> List[Dict]:
+        responses = []
+        next_token = None
+        for _ in range(self.max_pages):
+            await self._wait_rate_limit(self.api.RECENT_SEARCH_URL)
+            response = await self.api.search_recent(
+                make_rule_value(usernames), query, since_id=since_id, next_token=next_token)
+            self.stats['requests'] += 1
+            if 'data' in response:
+                responses.append(response)
+            next_token = response.get('meta', {}).get('next_token', None)
+            if next_token is None:
+                break
+        else:
+            # 搜索结果从新到旧，没拉完的是最早的那部分
+            raise BackfillIncomplete(f'more than {self.max_pages} pages of tweets since {since_id}')
+        return responses
+
+    async def _hydrate_quoted(self, responses: List[Dict]):
+        """
+        search返回的includes里被引用的推文没有附件，用批量查询一次取回所有被引用推文的图片，
+        免得转发时再逐条查询
+        """
+        quoted_ids = sorted({ref['id'] for response in responses for tweet in response['data']
+                             for ref in tweet.get('referenced_tweets', []) if ref['type'] == 'quoted'})
+        media_query = {'expansions': 'attachments.media_keys', 'media.fields': 'type,url'}
+        hydrated: Dict[str, Dict] = {}
+        media: List[Dict] = []
+        for i in range(0, len(quoted_ids), 100):
+            lookup = await self.api.tweets_lookup(quoted_ids[i:i + 100], media_query)
+            self.stats['requests'] += 1
+            hydrated.update({tweet['id']: tweet for tweet in lookup.get('data', [])})
+            media.extend(lookup.get('includes', {}).get('media', []))
+        if not hydrated:
+            return
+        for response in responses:
+            includes = response.setdefault('includes', {})
+            for tweet in includes.get('tweets', []):
+                if tweet['id'] in hydrated:
+                    tweet['attachments'] = hydrated[tweet['id']].get('attachments', {'media_keys': []})
+            includes['media'] = includes.get('media', []) + media
+
+    async def backfill(self, handler: Callable[[Tweet], Coroutine], query: Dict,
+                       last_seen: Optional[Dict[str, str]] = None, newest_id: Optional[int] = None) -> int:
+        """
+        Args:
+            last_seen (dict, optional): 断线前各用户最后收到的推文id，默认为当前的记录
+            newest_id (int, optional): 断线前stream收到的最新推文id，默认为当前的记录
+        """
+        # 重连之后stream推来的推文会更新last_seen，需要断线时的快照
+        if last_seen is None:
+            last_seen, newest_id = dict(self.last_seen), self.newest_id
+        last_seen = {username: last_seen[username]
+                     for username in self.listener.subscribe_users if username in last_seen}
+        if not last_seen:
+            return 0
+        self.stats['runs'] += 1
+
+        floor_id = snowflake_at(time.time() - RECENT_SEARCH_WINDOW)
+        responses: List[Dict] = []
+        for usernames in pack_usernames(list(last_seen), self.max_query_length):
+            since_id = min(int(last_seen[username]) for username in usernames)
+            if newest_id is not None:
+                since_id = max(since_id, newest_id)
+            if since_id < floor_id:
+                logger.info(f'Backfill for {usernames} can only reach tweets of the last 7 days')
+                since_id = floor_id
+            try:
+                # 一组用户只拉到一部分（出错或页数用完）时整组放弃，
+                # 否则较新的推文会推进last_seen，较早的就再也补不回来
+                responses.extend(await self._search(usernames, str(since_id), query))
+            except BackfillIncomplete as e:
+                logger.warning(f'Backfill for {usernames} skipped, {e}')
+            except TwitterAPIException as e:
+                logger.error(f'Backfill for {usernames} failed due to twitter error {e.code}: {e.data}')
+            except Exception as e:
+                logger.error(f'Backfill for {usernames} failed due to error: {e}')
+        try:
+            await self._hydrate_quoted(responses)
+        except TwitterAPIException as e:
+            logger.warning(f'Failed to look up quoted tweets, twitter error {e.code}: {e.data}')
+        except Exception as e:
+            logger.warning(f'Failed to look up quoted tweets: {e}')
+
+        missed: Dict[str, Tweet] = {}
+        for response in responses:
+            includes = TweetIncludes(response.get('includes', {}))
+            for data in response['data']:
+                tweet = Tweet(**data, tweet_includes=includes)
+                author = tweet.author
+                if (author is None or author.username not in last_seen
+                        or int(tweet.id) <= int(last_seen[author.username])
+                        or (self.seen is not None and self.seen(tweet.id))):
+                    continue
+                missed[tweet.id] = tweet
+
+        tweets = sorted(missed.values(), key=lambda tweet: int(tweet.id))
+        if tweets:
+            logger.info(f'Backfilling {len(tweets)} tweets missed while disconnected')
+        for tweet in tweets:
+            await handler(tweet)
+        self.stats['backfilled'] += len(tweets)
+        metrics.inc('t2b_backfill_tweets_total', len(tweets))
+        return len(tweets)
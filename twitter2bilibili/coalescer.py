@@ -0,0 +1,108 @@
+import asyncio
+from loguru import logger
+from bilibili_api.comment import ResourceType
+
+from .metrics import metrics
+
+from typing import Callable, Coroutine, Dict, List, Optional, Tuple
+
+
+class _Batch:
+    __slots__ = ('dynamic_id', 'target', 'items', 'timer')
+
+    def __init__(self, dynamic_id: int) -> None:
+        self.dynamic_id = dynamic_id
+        self.target: Optional[Tuple[ResourceType, int]] = None
+        self.items: List[Tuple[str, asyncio.Future]] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class CommentCoalescer:
+    """
+    把window秒内发往同一动态的评论按顺序合并，在不超过max_length的前提下拼成尽量少的评论发出。
+    add立即返回一个Future，合并后的评论发出后得到结果
+    """
+
+    def __init__(self, send_comment: Callable[..., Coroutine], window: float = 5,
+                 max_length: int = 1000, separator: str = '\n\n') -> None:
+        self.send_comment = send_comment
+        self.window = window
+        self.max_length = max_length
+        self.separator = separator
+
+        self._batches: Dict[int, _Batch] = {}
+        self._flushing: List[asyncio.Task] = []
+        self.stats = {'replies': 0, 'comments': 0, 'merged': 0}
+
+    def add(self, text: str, dynamic_id: int,
+            target: Optional[Tuple[ResourceType, int]] = None) -> asyncio.Future:
+        loop = asyncio.get_event_loop()
+        batch = self._batches.get(dynamic_id, None)
+        if batch is None:
+            batch = self._batches[dynamic_id] = _Batch(dynamic_id)
+            batch.timer = loop.call_later(self.window, self._flush, dynamic_id)
+        if batch.target is None:
+            batch.target = target
+        future = loop.create_future()
+        batch.items.append((text, future))
+        self.stats['replies'] += 1
+        return future
+
+    def _pack(self, texts: List[str]) -> List[List[int]]:
+        # 按顺序装入，放不下就开始新的一条，超长的单条评论单独发送
+        groups: List[List[int]] = []
+        length = 0
+        for i, text in enumerate(texts):
+            if groups and length + len(self.separator) + len(text) <= self.max_length:
+                groups[-1].append(i)
+                length += len(self.separator) + len(text)
+            else:
+                groups.append([i])
+                length = len(text)
+        return groups
+
+    def _flush(self, dynamic_id: int):
+        batch = self._batches.pop(dynamic_id, None)
+        if batch is None:
+            return
+        batch.timer.cancel()
+        task = asyncio.ensure_future(self._send_batch(batch))
+        self._flushing.append(task)
+        task.add_done_callback(self._flushing.remove)
+
+    async def _send_batch(self, batch: _Batch):
+        texts = [text for text, _ in batch.items]
+        groups = self._pack(texts)
+        merged = len(texts) - len(groups)
+        if merged:
+            logger.info(f'Merged {len(texts)} comments on dynamic {batch.dynamic_id} into {len(groups)}')
+        self.stats['comments'] += len(groups)
+        self.stats['merged'] += merged
+        metrics.inc('t2b_comments_merged_total', merged)
+
+        try:
+            for group in groups:
+                futures = [batch.items[i][1] for i in group]
+                try:
+                    response = await self.send_comment(
+                        text=self.separator.join(texts[i] for i in group),
+                        dynamic_id=batch.dynamic_id, target=batch.target)
+                except Exception as e:
+                    for future in futures:
+                        future.set_exception(e)
+                else:
+                    for future in futures:
+                        future.set_result(response)
+        finally:
+            # 被取消时还没发出的评论
+            for _, future in batch.items:
+                if not future.done():
+                    future.cancel()
+
+    async def close(self):
+        """
+        立即发出所有还在等待窗口中的评论
+        """
+        for dynamic_id in list(self._batches):
+            self._flush(dynamic_id)
+        await asyncio.gather(*self._flushing, return_exceptions=True)
@@ -0,0 +1,85 @@
+import time
+import asyncio
+from collections import OrderedDict
+
+from .metrics import metrics
+
+from typing import Callable, Coroutine, Dict, Optional
+
+
+class Deduplicator:
+    """
+    转发前的推文去重。重连后的重复推送、多条规则同时命中、补抓与stream重叠都会让同一条推文到达多次。
+
+    最近见过的推文id按LRU保留max_size个，设置window时超过window秒的也会淘汰；
+    不在其中的再用persisted（如查询转发记录）判断。同一推文的并发处理共用一个任务
+    """
+
+    def __init__(self, max_size: int = 10000, window: Optional[float] = None,
+                 persisted: Optional[Callable[[str], bool]] = None) -> None:
+        self.max_size = max_size
+        self.window = window
+        self.persisted = persisted
+
+        self._recent: 'OrderedDict[str, float]' = OrderedDict()
+        self._tasks: Dict[str, asyncio.Future] = {}
+        self.stats = {'unique': 0, 'recent': 0, 'persisted': 0, 'in_flight': 0}
+
+    def _evict(self, now: float):
+        while self._recent:
+            if len(self._recent) > self.max_size:
+                self._recent.popitem(last=False)
+                continue
+            if self.window is not None and now - next(iter(self._recent.values())) > self.window:
+                self._recent.popitem(last=False)
+                continue
+            break
+
+    def seen(self, tweet_id) -> bool:
+        tweet_id = str(tweet_id)
+        self._evict(time.monotonic())
+        return tweet_id in self._recent or (self.persisted is not None and self.persisted(tweet_id))
+
+    def add(self, tweet_id):
+        tweet_id = str(tweet_id)
+        now = time.monotonic()
+        self._recent.pop(tweet_id, None)
+        self._recent[tweet_id] = now
+        self._evict(now)
+
+    def _suppressed(self, reason: str):
+        self.stats[reason] += 1
+        metrics.inc('t2b_duplicates_suppressed_total', reason=reason)
+
+    def check(self, tweet_id) -> bool:
+        """
+        第一次见到的推文返回True并记下，重复的返回False
+        """
+        tweet_id = str(tweet_id)
+        now = time.monotonic()
+        self._evict(now)
+        if tweet_id in self._recent:
+            self._recent.move_to_end(tweet_id)
+            self._suppressed('recent')
+            return False
+        if self.persisted is not None and self.persisted(tweet_id):
+            self._suppressed('persisted')
+            self.add(tweet_id)
+            return False
+        self.stats['unique'] += 1
+        self.add(tweet_id)
+        return True
+
+    async def run_once(self, tweet_id, func: Callable[[], Coroutine]):
+        """
+        执行func()，同一推文正在执行时等待已有的任务而不是再执行一次
+        """
+        tweet_id = str(tweet_id)
+        task = self._tasks.get(tweet_id, None)
+        if task is not None:
+            self._suppressed('in_flight')
+            # 等待者被取消不影响正在执行的任务
+            return await asyncio.shield(task)
+        task = self._tasks[tweet_id] = asyncio.ensure_future(func())
+        task.add_done_callback(lambda _: self._tasks.pop(tweet_id, None))
+        return await task
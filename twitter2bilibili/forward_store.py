@@ -0,0 +1,311 @@
+import os
+import json
+import time
+import asyncio
+import sqlite3
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from loguru import logger
+
+from typing import Dict, Iterator, Optional, Set, Tuple
+
+
+class TTLStore:
+    """
+    key到记录的存储，记录写入valid_time后失效，如推文id到转发记录、图片内容到上传后的图片信息。
+    内存中维护按写入时间排序的索引，查找和写入均为O(1)，过期记录从最旧一端依次淘汰。子类只负责持久化。
+
+    记录为字典，写入时自动加上'time'（unix时间戳）
+    """
+
+    def __init__(self, valid_time: timedelta = timedelta(weeks=1)) -> None:
+        self.valid_time = valid_time
+        self._index: 'OrderedDict[str, Dict]' = OrderedDict()
+        # touch过、时间还没有写入的key
+        self._touched: Set[str] = set()
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, key) -> bool:
+        return self.get(key) is not None
+
+    def _load(self) -> Iterator[Tuple[str, Dict]]:
+        raise NotImplementedError
+
+    def _persist(self, key: str, record: Dict):
+        raise NotImplementedError
+
+    def _persist_eviction(self, cutoff: float, evicted: int):
+        pass
+
+    async def stop(self):
+        """
+        完成事件循环中还没做完的持久化，事件循环结束前调用
+        """
+        pass
+
+    def close(self):
+        pass
+
+    def open(self):
+        for key, record in self._load():
+            self._index.pop(key, None)
+            self._index[key] = record
+        self.evict_expired()
+
+    def evict_expired(self, now: Optional[float] = None) -> int:
+        if now is None:
+            now = time.time()
+        cutoff = now - self.valid_time.total_seconds()
+        evicted = 0
+        while self._index:
+            key, record = next(iter(self._index.items()))
+            if record['time'] >= cutoff:
+                break
+            self._index.popitem(last=False)
+            self._touched.discard(key)
+            evicted += 1
+        if evicted:
+            self._persist_eviction(cutoff, evicted)
+        return evicted
+
+    def get(self, key) -> Optional[Dict]:
+        record = self._index.get(str(key), None)
+        if record is None or time.time() - record['time'] > self.valid_time.total_seconds():
+            return None
+        return record
+
+    def put(self, key, record: Dict, record_time: Optional[float] = None):
+        key = str(key)
+        record = dict(record, time=time.time() if record_time is None else record_time)
+        # 保证索引按写入时间有序，过期淘汰只需看头部
+        self._index.pop(key, None)
+        self._index[key] = record
+        self._touched.discard(key)
+        self._persist(key, record)
+        self.evict_expired()
+
+    def touch(self, key) -> Optional[Dict]:
+        """
+        刷新记录的时间使其不过期，返回该记录，没有时返回None。
+        只修改内存，新的时间在子类压缩或关闭时才写入，进程崩溃时记录按原来的时间过期
+        """
+        key = str(key)
+        record = self.get(key)
+        if record is None:
+            return None
+        record['time'] = time.time()
+        self._index.move_to_end(key)
+        self._touched.add(key)
+        return record
+
+
+class JsonLinesStore(TTLStore):
+    """
+    追加写日志，每行一条记录。启动时回放日志重建索引，末尾写了一半的行（进程崩溃）会被跳过。
+    失效行过多时整体压缩重写，用os.replace保证原子性。
+
+    每条记录立即写入并flush到操作系统：转发记录是重放outbox时避免重复发送的依据，
+    进程崩溃（最常见的退出方式）后也必须还在，而write只是拷贝到页缓存，不会明显阻塞事件循环。
+    只防断电的fsync在事件循环中时合并为每sync_interval秒一次，在线程池中进行
+    """
+
+    def __init__(self, path: str, valid_time: timedelta = timedelta(weeks=1),
+                 compact_threshold: int = 1000, sync_interval: float = 0.2) -> None:
+        super().__init__(valid_time)
+        self.path = path
+        self.compact_threshold = compact_threshold
+        self.sync_interval = sync_interval
+        self._log_lines = 0
+        self._file = None
+        self._unsynced = False
+        self._syncer: Optional[asyncio.Task] = None
+
+    def _load(self) -> Iterator[Tuple[str, Dict]]:
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                self._log_lines += 1
+                try:
+                    record = json.loads(line)
+                    key = record.pop('id')
+                except (ValueError, KeyError):
+                    logger.warning(f'Skipped broken line in {self.path}: {line!r}')
+                    continue
+                yield key, record
+
+    def open(self):
+        super().open()
+        self._compact()
+
+    def _append(self, line: str):
+        if self._file is None:
+            self._file = open(self.path, 'a', encoding='utf-8')
+        self._file.write(line)
+        self._file.flush()
+        self._log_lines += 1
+        self._unsynced = True
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # 不在事件循环中（启动时迁移旧记录等），直接同步
+            self._sync_now()
+            return
+        if self._syncer is None:
+            self._syncer = asyncio.ensure_future(self._sync_later())
+
+    def _sync_now(self):
+        if self._unsynced and self._file is not None:
+            os.fsync(self._file.fileno())
+        self._unsynced = False
+
+    async def _sync_later(self):
+        try:
+            # fsync期间又有写入时继续下一轮
+            while self._unsynced:
+                await asyncio.sleep(self.sync_interval)
+                if self._file is None:
+                    break
+                # 复制一份fd，线程池中fsync时文件被压缩关闭也不影响
+                fd = os.dup(self._file.fileno())
+                self._unsynced = False
+                try:
+                    await asyncio.get_event_loop().run_in_executor(None, os.fsync, fd)
+                finally:
+                    os.close(fd)
+        except OSError as e:
+            logger.error(f'Failed to sync {self.path}: {e}')
+        finally:
+            self._syncer = None
+
+    async def stop(self):
+        if self._syncer is not None:
+            self._syncer.cancel()
+            await asyncio.gather(self._syncer, return_exceptions=True)
+            self._syncer = None
+        self._sync_now()
+
+    def _persist(self, key: str, record: Dict):
+        self._append(json.dumps(dict(record, id=key)) + '\n')
+        # 同一key重复写入也会留下失效行
+        if self._log_lines - len(self._index) > self.compact_threshold:
+            self._compact()
+
+    def _persist_eviction(self, cutoff: float, evicted: int):
+        if self._log_lines - len(self._index) > self.compact_threshold:
+            self._compact()
+
+    def _compact(self):
+        if self._log_lines == len(self._index) and not self._touched:
+            return
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        # 压缩后的文件会fsync
+        self._unsynced = False
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for key, record in self._index.items():
+                f.write(json.dumps(dict(record, id=key)) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._log_lines = len(self._index)
+        self._touched.clear()
+
+    def close(self):
+        # 写入touch过的记录的时间
+        if self._touched:
+            self._compact()
+        if self._file is not None:
+            self._sync_now()
+            self._file.close()
+            self._file = None
+
+
+class SqliteStore(TTLStore):
+    def __init__(self, path: str, valid_time: timedelta = timedelta(weeks=1), table: str = 'forward_info') -> None:
+        super().__init__(valid_time)
+        self.path = path
+        self.table = table
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            # WAL模式下NORMAL只在checkpoint时fsync，写入不在事件循环中等待磁盘，进程崩溃不会丢失数据
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            # 列名tweet_id沿用最初只存转发记录时的表结构
+            self._conn.execute(
+                f'CREATE TABLE IF NOT EXISTS {self.table} '
+                '(tweet_id TEXT PRIMARY KEY, time REAL NOT NULL, data TEXT NOT NULL)')
+            self._conn.execute(
+                f'CREATE INDEX IF NOT EXISTS {self.table}_time ON {self.table} (time)')
+        return self._conn
+
+    def _load(self) -> Iterator[Tuple[str, Dict]]:
+        cursor = self._connect().execute(
+            f'SELECT tweet_id, time, data FROM {self.table} ORDER BY time')
+        for key, record_time, data in cursor:
+            yield key, dict(json.loads(data), time=record_time)
+
+    def _persist(self, key: str, record: Dict):
+        data = {field: value for field, value in record.items() if field != 'time'}
+        self._connect().execute(
+            f'INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?)',
+            (key, record['time'], json.dumps(data)))
+
+    def _persist_eviction(self, cutoff: float, evicted: int):
+        self._connect().execute(f'DELETE FROM {self.table} WHERE time < ?', (cutoff,))
+
+    def close(self):
+        if self._touched and self._conn is not None:
+            self._conn.executemany(
+                f'UPDATE {self.table} SET time = ? WHERE tweet_id = ?',
+                [(self._index[key]['time'], key) for key in self._touched if key in self._index])
+            self._touched.clear()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def migrate_json_forward_info(store: TTLStore, json_path: str) -> int:
+    """
+    将旧版forward_info.json中的记录导入store，导入后将原文件重命名为*.migrated
+    """
+    if not os.path.exists(json_path):
+        return 0
+    with open(json_path, 'r') as f:
+        forward_info: Dict[str, Dict] = json.load(f)
+
+    entries = []
+    for tweet_id, value in forward_info.items():
+        record_time = datetime.strptime(value.pop('time'), '%Y-%m-%d %H:%M:%S').timestamp()
+        entries.append((record_time, tweet_id, value))
+    for record_time, tweet_id, value in sorted(entries, key=lambda e: e[0]):
+        store.put(tweet_id, value, record_time=record_time)
+
+    os.replace(json_path, json_path + '.migrated')
+    logger.info(f'Migrated {len(entries)} forward records from {json_path}')
+    return len(entries)
+
+
+FORWARD_INFO_STORES = {
+    'jsonl': JsonLinesStore,
+    'sqlite': SqliteStore
+}
+
+
+def make_forward_info_store(backend: str, path: str,
+                            valid_time: timedelta = timedelta(weeks=1)) -> TTLStore:
+    try:
+        store_class = FORWARD_INFO_STORES[backend]
+    except KeyError:
+        raise ValueError(f'unknown forward info store backend {backend}, '
+                         f'should be one of {list(FORWARD_INFO_STORES)}')
+    store = store_class(path, valid_time=valid_time)
+    store.open()
+    return store
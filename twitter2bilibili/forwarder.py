@@ -1,18 +1,48 @@
 import os
+import time
 import asyncio
-from signal import SIGINT, SIGTERM
+import importlib
+from functools import cached_property, partial
+from types import ModuleType
+from signal import SIGHUP, SIGINT, SIGTERM, SIGUSR1
 from loguru import logger
 
-import json
-from datetime import datetime, timedelta
-from bilibili_api.exceptions import ResponseCodeException as BiliCodeException
+from datetime import timedelta
 
+from .accounts import DEFAULT_ACCOUNT, BiliAccount, BiliComponents, account_path
+from .backfill import Backfiller
+from .dedupe import Deduplicator
+from .forward_store import JsonLinesStore, make_forward_info_store, migrate_json_forward_info
+from .image import ImageProcessor
+from .inflight import InFlightRegistry
 from .listener import TwitterListener
-from .sender import BiliSender
+from .media import MediaCache, MediaFetcher
+from .metrics import metrics, MetricsServer
+from .outbox import Outbox
+from .pipeline import TweetQueue
+from .profiler import LoopProfiler
+from .recorder import StreamRecorder
+from .rules import RuleLimitExceeded, RuleManager, pack_usernames
+from .startup import LazyModule, StartupProfile, import_module
+from .supervisor import ConnectionSupervisor
+from .text_filter import TextSanitizer
+from .tracing import Span, tracer
 from .tweet import Tweet
 from .twitter_api import TwitterAPI, TwitterAPIException
+from .utils.network import session_manager
 
-from typing import List, Dict, Tuple, Optional
+from typing import List, Dict, Tuple, Optional, TYPE_CHECKING
+if TYPE_CHECKING:
+    from bilibili_api.comment import ResourceType
+    from .coalescer import CommentCoalescer
+    from .scheduler import SendScheduler
+    from .sender import BiliSender
+
+
+# B站相关的模块在连上stream后于后台导入，或者在第一次用到时导入
+BILI_MODULES = ('.sender', '.scheduler', '.coalescer')
+bili_comment = LazyModule('bilibili_api.comment')
+bili_exceptions = LazyModule('bilibili_api.exceptions')
 
 
 class AbortForwarding(Exception):
@@ -27,29 +57,322 @@ class RetryForwarding(Exception):
 
 class T2BForwarder:
     def __init__(self, config_object) -> None:
+        self.config = config_object
+        self._reload_lock = asyncio.Lock()
+        self.config_watch_interval: Optional[float] = getattr(config_object, 'config_watch_interval', None)
+        self.startup = StartupProfile()
+        self._prepare_task: Optional[asyncio.Task] = None
+
+        with self.startup.phase('twitter'):
+            self._init_twitter(config_object)
+        with self.startup.phase('forward_store'):
+            self._init_accounts(config_object)
+        with self.startup.phase('pipeline'):
+            self._init_pipeline(config_object)
+
+        self.display_timezone: str = getattr(config_object, 'display_timezone')
+        self.gap_img_path: str = getattr(config_object, 'gap_img')
+        self.startup.mark('constructed')
+
+    def _init_twitter(self, config_object):
+        session_manager.configure(getattr(config_object, 'http_pools', {}))
         self.api = TwitterAPI(bearer_token=getattr(config_object, 'TWITTER_BEARER_TOKEN'))
+        stream_capture_dir = getattr(config_object, 'stream_capture_dir', None)
+        self.recorder: Optional[StreamRecorder] = None if stream_capture_dir is None else StreamRecorder(
+            stream_capture_dir,
+            max_bytes=getattr(config_object, 'stream_capture_max_bytes', 64 << 20),
+            max_files=getattr(config_object, 'stream_capture_max_files', 20))
         self.listener = TwitterListener(
             api=self.api,
-            subscribe_users=getattr(config_object, 'subscribe_users'))
-        self.sender = BiliSender(
-            sessdata=getattr(config_object, 'BILI_SESSDATA'),
-            bili_jct=getattr(config_object, 'BILI_BILI_JCT'),
-            dedeuserid=getattr(config_object, 'BILI_DEDE'))
+            subscribe_users=getattr(config_object, 'subscribe_users'),
+            supervisor=ConnectionSupervisor(stall_timeout=getattr(config_object, 'stream_stall_timeout', 60)),
+            recorder=self.recorder)
+        self.deduplicator = Deduplicator(
+            max_size=getattr(config_object, 'dedupe_max_size', 10000),
+            window=getattr(config_object, 'dedupe_window', None),
+            persisted=self._is_forwarded if getattr(config_object, 'dedupe_check_forward_store', True) else None)
+        backfill_state_path = getattr(config_object, 'backfill_state_path', 'backfill_state.json')
+        self.backfiller: Optional[Backfiller] = None if backfill_state_path is None else Backfiller(
+            self.api, self.listener, state_path=backfill_state_path,
+            max_query_length=getattr(config_object, 'rule_max_length', 512),
+            max_pages=getattr(config_object, 'backfill_max_pages', 5),
+            seen=self.deduplicator.seen)
+        self.rule_manager = RuleManager(
+            self.listener,
+            max_length=getattr(config_object, 'rule_max_length', 512),
+            max_count=getattr(config_object, 'rule_max_count', 5))
 
-        self.display_timezone: str = getattr(config_object, 'display_timezone')
+    def _init_accounts(self, config_object):
+        self._forward_info_valid_time = timedelta(weeks=1)
+        accounts_config = {DEFAULT_ACCOUNT: {
+            'sessdata': getattr(config_object, 'BILI_SESSDATA'),
+            'bili_jct': getattr(config_object, 'BILI_BILI_JCT'),
+            'dedeuserid': getattr(config_object, 'BILI_DEDE')}}
+        accounts_config.update(getattr(config_object, 'bili_accounts', {}))
+        self.accounts: Dict[str, BiliAccount] = {
+            name: self._make_account(name, account_config) for name, account_config in accounts_config.items()}
+        unknown_accounts = self._unknown_accounts(getattr(config_object, 'subscribe_users'))
+        if unknown_accounts:
+            raise ValueError(f'subscribe_users refer to unknown bilibili accounts {unknown_accounts}, '
+                             f'should be one of {list(self.accounts)}')
 
-        gap_img_path = getattr(config_object, 'gap_img')
-        with open(gap_img_path, 'rb') as f:
-            self.gap_img: bytes = f.read()
+        # 默认账号，只有一个账号时与原来的用法相同
+        self.forward_store = self.accounts[DEFAULT_ACCOUNT].forward_store
+        # 旧版本的转发记录
+        migrate_json_forward_info(self.forward_store, 'forward_info.json')
 
-        self._forward_info_file = 'forward_info.json'
-        self._forward_info_valid_time = timedelta(weeks=1)
+    def _init_pipeline(self, config_object):
+        self.queue = TweetQueue(
+            handler=self.deduplicated_handler,
+            maxsize=getattr(config_object, 'queue_size', 100),
+            workers=getattr(config_object, 'queue_workers', 4),
+            put_timeout=getattr(config_object, 'queue_put_timeout', 10))
+
+        self.in_flight = InFlightRegistry(timeout=getattr(config_object, 'parent_wait_timeout', 60))
+
+        self.outbox = Outbox(getattr(config_object, 'outbox_path', 'outbox.jsonl'))
+
+        self.media_fetcher = MediaFetcher(
+            cache=MediaCache(
+                memory_bytes=getattr(config_object, 'media_cache_memory_bytes', 64 << 20),
+                disk_dir=getattr(config_object, 'media_cache_dir', 'media_cache'),
+                disk_bytes=getattr(config_object, 'media_cache_disk_bytes', 512 << 20)),
+            max_concurrency=getattr(config_object, 'media_max_concurrency', 8),
+            max_bytes=getattr(config_object, 'media_max_bytes', 20 << 20))
+
+        image_max_dimension = getattr(config_object, 'image_max_dimension', 2048)
+        self.image_processor: Optional[ImageProcessor] = None if image_max_dimension is None else ImageProcessor(
+            max_dimension=image_max_dimension,
+            quality=getattr(config_object, 'image_quality', 85),
+            max_bytes=getattr(config_object, 'image_max_bytes', 10 << 20),
+            workers=getattr(config_object, 'image_workers', 2))
+
+        metrics_port = getattr(config_object, 'metrics_port', None)
+        if metrics_port is not None:
+            metrics.enabled = True
+            self.metrics_server: Optional[MetricsServer] = MetricsServer(port=metrics_port)
+            self._register_gauges()
+        else:
+            self.metrics_server = None
+
+        trace_path = getattr(config_object, 'trace_path', None)
+        if trace_path is not None:
+            tracer.open(trace_path, sample_rate=getattr(config_object, 'trace_sample_rate', 1.0))
+        # 收到后还没处理完的推文的trace
+        self._traces: Dict[str, Span] = {}
+        # 等待合并发出的评论：推文id -> (评论所在的动态id, 评论目标)，回复它的推文评论到同一条动态下
+        self._queued_comments: Dict[str, Tuple[int, Optional[Tuple['ResourceType', int]]]] = {}
+
+        self.profiler = LoopProfiler(
+            output_dir=getattr(config_object, 'profile_dir', 'profiles'),
+            interval=getattr(config_object, 'profile_interval', 0.005),
+            max_seconds=getattr(config_object, 'profile_max_seconds', 60))
+
+    @cached_property
+    def gap_img(self) -> bytes:
+        with open(self.gap_img_path, 'rb') as f:
+            return f.read()
+
+    @cached_property
+    def sanitizer(self) -> TextSanitizer:
+        return TextSanitizer(
+            word_list_path=getattr(self.config, 'illegal_words_path', None),
+            learned_path=getattr(self.config, 'learned_words_path', 'learned_words.json'))
+
+    @cached_property
+    def image_cache(self) -> Optional[JsonLinesStore]:
+        uploaded_images_path = getattr(self.config, 'uploaded_images_path', 'uploaded_images.jsonl')
+        if uploaded_images_path is None:
+            return None
+        image_cache = JsonLinesStore(
+            uploaded_images_path,
+            valid_time=timedelta(days=getattr(self.config, 'uploaded_images_valid_days', 30)))
+        image_cache.open()
+        return image_cache
+
+    # 默认账号的组件
+    @property
+    def sender(self) -> 'BiliSender':
+        return self.accounts[DEFAULT_ACCOUNT].sender
+
+    @property
+    def scheduler(self) -> 'SendScheduler':
+        return self.accounts[DEFAULT_ACCOUNT].scheduler
+
+    @property
+    def coalescer(self) -> Optional['CommentCoalescer']:
+        return self.accounts[DEFAULT_ACCOUNT].coalescer
+
+    def _make_account(self, name: str, account_config: Dict) -> BiliAccount:
+        forward_store = make_forward_info_store(
+            backend=getattr(self.config, 'forward_info_store', 'jsonl'),
+            path=account_path(getattr(self.config, 'forward_info_path', 'forward_info.jsonl'), name),
+            valid_time=self._forward_info_valid_time)
+        return BiliAccount(name, forward_store, partial(self._make_bili_components, account_config))
+
+    @staticmethod
+    def _load_bili_modules():
+        for name in BILI_MODULES:
+            import_module(name, __package__)
+
+    def _make_bili_components(self, account_config: Dict) -> BiliComponents:
+        """
+        account_config除凭据外可以单独设置send_rate、send_burst和send_max_retries
+        """
+        self._load_bili_modules()
+        from .coalescer import CommentCoalescer
+        from .scheduler import SendScheduler
+        from .sender import BiliSender
+
+        config_object = self.config
+        sender = BiliSender(
+            sessdata=account_config['sessdata'],
+            bili_jct=account_config['bili_jct'],
+            dedeuserid=account_config['dedeuserid'],
+            sanitizer=self.sanitizer,
+            image_cache=self.image_cache)
+        scheduler = SendScheduler(
+            sender,
+            rate=account_config.get('send_rate', getattr(config_object, 'send_rate', 0.5)),
+            burst=account_config.get('send_burst', getattr(config_object, 'send_burst', 3)),
+            max_retries=account_config.get('send_max_retries', getattr(config_object, 'send_max_retries', 5)))
+
+        comment_coalesce_window = getattr(config_object, 'comment_coalesce_window', None)
+        coalescer = None if comment_coalesce_window is None else CommentCoalescer(
+            scheduler.send_comment, window=comment_coalesce_window,
+            max_length=getattr(config_object, 'comment_max_length', 1000))
+        return sender, scheduler, coalescer
+
+    async def prepare_bili(self):
+        """
+        在后台线程导入B站相关的模块，再创建各账号的发送器等组件，之后的第一条推文不用再等待导入
+        """
+        await asyncio.get_event_loop().run_in_executor(None, self._load_bili_modules)
+        for account in self.accounts.values():
+            account.load()
+        self.startup.mark('bilibili_ready')
+        logger.info(f'Bilibili components are ready in {self.startup.marks["bilibili_ready"]:.3f}s after start')
 
+    def _unknown_accounts(self, subscribe_users: List[Dict]) -> List[str]:
+        return sorted({user.get('account', DEFAULT_ACCOUNT) for user in subscribe_users} - set(self.accounts))
+
+    def account_of(self, username: str) -> Optional[BiliAccount]:
+        """
+        订阅用户的推文转发到的账号，不是订阅用户时返回None
+        """
+        user = self.listener.subscribe_users.get(username, None)
+        if user is None:
+            return None
+        return self.accounts.get(user.get('account', DEFAULT_ACCOUNT), self.accounts[DEFAULT_ACCOUNT])
+
+    def _is_forwarded(self, tweet_id: str) -> bool:
+        return any(tweet_id in account.forward_store for account in self.accounts.values())
+
+    def get_account(self, tweet: Tweet) -> BiliAccount:
+        account = self.account_of(tweet.author.username) if tweet.author is not None else None
+        return account if account is not None else self.accounts[DEFAULT_ACCOUNT]
+
+    def _register_gauges(self):
+        metrics.gauge('t2b_queue_depth', lambda: self.queue.depth)
+        metrics.gauge('t2b_queue_overflowed', lambda: self.queue.stats['overflow'])
+        metrics.gauge('t2b_queue_backpressure_seconds', lambda: self.queue.stats['backpressure_seconds'])
+        metrics.gauge('t2b_send_queue_depth', lambda: sum(
+            account.scheduler._queue.qsize() for account in self.accounts.values()
+            if account.loaded and account.scheduler._queue is not None))
+        metrics.gauge('t2b_send_rate', lambda: sum(
+            account.scheduler.bucket.rate for account in self.accounts.values() if account.loaded))
+        metrics.gauge('t2b_stream_connects', lambda: self.listener.connect_count)
+        metrics.gauge('t2b_stream_idle_seconds', lambda: self.listener.idle_seconds)
+        metrics.gauge('t2b_stream_keep_alive_interval_seconds',
+                      lambda: self.listener.supervisor.keep_alive_interval or 0)
+
+    async def reload_config(self):
+        """
+        重新读取配置模块，原地更新订阅用户和显示设置，并只向推特提交规则的变化，stream连接不会断开
+        """
+        async with self._reload_lock:
+            if isinstance(self.config, ModuleType):
+                try:
+                    self.config = importlib.reload(self.config)
+                except Exception as e:
+                    logger.error(f'Failed to reload config, keep using the old one: {e}')
+                    return
+
+            old_users = list(self.listener.subscribe_users.values())
+            old_usernames = set(self.listener.subscribe_users)
+            subscribe_users = getattr(self.config, 'subscribe_users')
+            new_usernames = {user['username'] for user in subscribe_users}
+            # 先确认新的用户能装进规则数上限，放不下时不做任何改动
+            try:
+                pack_usernames(sorted(new_usernames), self.rule_manager.max_length, self.rule_manager.max_count)
+            except RuleLimitExceeded as e:
+                logger.error(f'Failed to reload config, keep using the old subscribed users: {e}')
+                return
+
+            unknown_accounts = self._unknown_accounts(subscribe_users)
+            if unknown_accounts:
+                logger.error(f'Unknown bilibili accounts {unknown_accounts} in subscribe_users, '
+                             f'tweets of these users will be forwarded by the default account')
+            self.listener.update_subscribe_users(subscribe_users)
+            self.display_timezone = getattr(self.config, 'display_timezone')
+            logger.info(f'Reloaded config, subscribed users added: {new_usernames - old_usernames}, '
+                        f'removed: {old_usernames - new_usernames}')
+            if new_usernames != old_usernames:
+                try:
+                    await self.rule_manager.sync(new_usernames)
+                except (TwitterAPIException, Exception) as e:
+                    # TwitterAPIException继承自BaseException，需要单独捕获
+                    if isinstance(e, TwitterAPIException):
+                        logger.error(f'Failed to update stream rules, twitter error {e.code}: {e.data}')
+                    else:
+                        logger.error(f'Failed to update stream rules: {e!r}')
+                    # 规则没有更新，订阅用户也恢复原样，下次重新加载时再同步
+                    logger.warning('Restored the old subscribed users')
+                    self.listener.update_subscribe_users(old_users)
+
+    async def _watch_config(self):
+        path = getattr(self.config, '__file__', None)
+        if path is None:
+            return
+        mtime = os.stat(path).st_mtime
+        while True:
+            await asyncio.sleep(self.config_watch_interval)
+            try:
+                new_mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            if new_mtime != mtime:
+                mtime = new_mtime
+                try:
+                    await self.reload_config()
+                except TwitterAPIException as e:
+                    logger.error(f'Failed to reload config, twitter error {e.code}: {e.data}')
+                except Exception as e:
+                    # 继续监视，配置改好后再次加载
+                    logger.error(f'Failed to reload config: {e!r}')
+
+    @tracer.traced('download_photos')
     async def _download_photos(self, tweet: Tweet) -> List[bytes]:
-        photo_media = filter(lambda m: m.type == 'photo', await tweet.get_media(twitter_api=self.api))
-        download_photo_coroutines = [media.get_photo()
-                                     for media in photo_media]
-        return await asyncio.gather(*download_photo_coroutines)
+        with metrics.timer('t2b_stage_seconds', stage='get_media'):
+            media = await tweet.get_media(twitter_api=self.api)
+        photo_media = filter(lambda m: m.type == 'photo', media)
+        urls = [media.url for media in photo_media]
+        if self.image_processor is not None:
+            urls = list(map(self.image_processor.variant_url, urls))
+        with metrics.timer('t2b_stage_seconds', stage='download_photos'):
+            photos = await self.media_fetcher.fetch_all(urls)
+        metrics.inc('t2b_photo_bytes_total', sum(map(len, photos)))
+        tracer.annotate(tweet_id=tweet.id, photos=len(photos), bytes=sum(map(len, photos)))
+
+        if self.image_processor is not None and photos:
+            with metrics.timer('t2b_stage_seconds', stage='process_photos'):
+                photos, report = await self.image_processor.process_all(photos)
+            metrics.inc('t2b_photo_bytes_saved_total', report['bytes_in'] - report['bytes_out'])
+            tracer.annotate(bytes_processed=report['bytes_out'], process_seconds=round(report['seconds'], 6))
+            logger.info(f'Processed {len(photos)} photos of tweet id {tweet.id}: '
+                        f'{report["bytes_in"] / 1024:.0f}KB -> {report["bytes_out"] / 1024:.0f}KB '
+                        f'in {report["seconds"]:.2f}s')
+        return photos
 
     @property
     def query(self) -> Dict:
@@ -59,72 +382,83 @@ class T2BForwarder:
             'media.fields': 'type,url', 'user.fields': 'username'}
 
     async def listener_initializer(self, listener: TwitterListener):
-        await listener.get_rules()
-        all_ids = [rule['id'] for rule in listener.rules]
-        await listener.delete_rules(all_ids)
-        await listener.add_rules(listener._make_rules('t2b'))
+        await self.rule_manager.sync(set(listener.subscribe_users))
         logger.info(f'Start listening on rules: {listener.rules}')
 
-    def _load_forward_info_file(self) -> Dict:
-        if not os.path.exists(self._forward_info_file):
-            return {}
-        with open(self._forward_info_file, 'r') as f:
-            forward_info = json.load(f)
-        return forward_info
-
-    def _filter_valid_forward_info(self, forward_info: Dict) -> Dict:
-        valid_forward_info = forward_info.copy()
-        now = datetime.now()
-        for key, value in forward_info.items():
-            time = datetime.strptime(value['time'], '%Y-%m-%d %H:%M:%S')
-            if now-time > self._forward_info_valid_time:
-                valid_forward_info.pop(key)
-        return valid_forward_info
-
-    def _save_forward_info_file(self, forward_info: Dict):
-        valid_forward_info = self._filter_valid_forward_info(forward_info)
-        with open(self._forward_info_file, 'w') as f:
-            json.dump(valid_forward_info, f)
-
-    def save_forward_info(self, tweet: Tweet, dynamic_id: int):
-        forward_info = self._load_forward_info_file()
-        forward_info[tweet.id] = {
-            'dynamic_id': dynamic_id, 'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
-        self._save_forward_info_file(forward_info)
-
-    def get_forward_dynamic_id(self, tweet_id: int) -> Optional[int]:
-        forward_info = self._load_forward_info_file()
-        if str(tweet_id) in forward_info:     # json存储时会将整数key转成字符串
-            return forward_info[str(tweet_id)]['dynamic_id']
-        else:
+    def save_forward_info(self, tweet: Tweet, dynamic_id: int,
+                          comment_target: Optional[Tuple['ResourceType', int]] = None):
+        record = {'dynamic_id': dynamic_id}
+        if comment_target is not None:
+            record['comment_type'], record['comment_oid'] = comment_target[0].value, comment_target[1]
+        self.get_account(tweet).forward_store.put(tweet.id, record)
+        self.in_flight.resolve(tweet.id, dynamic_id)
+
+    def save_forward_marker(self, tweet: Tweet, action: str):
+        """
+        转发拿不到新动态的id，只记录已经发出，重放outbox时不会再发一次
+        """
+        self.get_account(tweet).forward_store.put(tweet.id, {'dynamic_id': None, 'action': action})
+
+    def get_comment_target(self, tweet_id: int,
+                           account: Optional[BiliAccount] = None) -> Optional[Tuple['ResourceType', int]]:
+        forward_store = self.forward_store if account is None else account.forward_store
+        record = forward_store.get(tweet_id)
+        if record is None and str(tweet_id) in self._queued_comments:
+            return self._queued_comments[str(tweet_id)][1]
+        if record is None or 'comment_type' not in record:
             return None
+        return bili_comment.ResourceType(record['comment_type']), record['comment_oid']
+
+    def get_forward_dynamic_id(self, tweet_id: int, account: Optional[BiliAccount] = None) -> Optional[int]:
+        """
+        推文由account（默认为默认账号）转发后的动态id，以评论转发的推文为评论所在的动态id
+        """
+        forward_store = self.forward_store if account is None else account.forward_store
+        record = forward_store.get(tweet_id)
+        if record is None and str(tweet_id) in self._queued_comments:
+            return self._queued_comments[str(tweet_id)][0]
+        return None if record is None else record['dynamic_id']
+
+    async def wait_forward_dynamic_id(self, tweet_id: int, account: Optional[BiliAccount] = None) -> Optional[int]:
+        """
+        与get_forward_dynamic_id相同，但推文正在转发时等它发出
+        """
+        dynamic_id = self.get_forward_dynamic_id(tweet_id, account)
+        if dynamic_id is None and tweet_id in self.in_flight:
+            logger.debug(f'Waiting for referenced tweet id {tweet_id} to be forwarded')
+            dynamic_id = await self.in_flight.wait(tweet_id)
+        return dynamic_id
 
-    def get_forward_action(self, tweet: Tweet) -> Tuple[str, Optional[int]]:
+    @tracer.traced('get_forward_action')
+    async def get_forward_action(self, tweet: Tweet) -> Tuple[str, Optional[int]]:
         if tweet.type == 'original':
             return 'send', None
         elif tweet.type == 'retweeted':
             # 不带内容转推，认为是纯工商推，不处理
             raise AbortForwarding
         else:
-            ref_subscribed = tweet.referenced_tweet.author.username in self.listener.subscribe_users
+            # 只关联同一账号转发的推文
+            account = self.get_account(tweet)
+            ref_subscribed = self.account_of(tweet.referenced_tweet.author.username) is account
             if tweet.type == 'quoted':
                 if ref_subscribed:
-                    dynamic_id = self.get_forward_dynamic_id(tweet.referenced_tweet.id)
+                    dynamic_id = await self.wait_forward_dynamic_id(tweet.referenced_tweet.id, account)
                     if dynamic_id is not None:
                         return ('send', dynamic_id) if tweet.media else ('repost', dynamic_id)
                 return 'send', None
             elif tweet.type == 'replied_to':
                 if ref_subscribed:
-                    dynamic_id = self.get_forward_dynamic_id(tweet.referenced_tweet.id)
+                    dynamic_id = await self.wait_forward_dynamic_id(tweet.referenced_tweet.id, account)
                     if dynamic_id is not None:
                         return 'comment', dynamic_id
                 # 只搬对已经转到B站的推的评论
                 raise AbortForwarding
 
+    @tracer.traced('send_dynamic')
     async def on_send_dynamic(self, tweet: Tweet, dynamic_id: Optional[int]):
         text = '{}于{}'.format(
             self.listener.get_author_name(tweet.author),
-            tweet.get_create_time(self.display_timezone).strftime('%Y-%m-%d %H:%M:%S'))
+            tweet.format_create_time(self.display_timezone))
         if tweet.type == 'original':
             text += '发推：\n' + tweet.parse_text()
         elif tweet.type == 'quoted':
@@ -137,65 +471,240 @@ class T2BForwarder:
             else:
                 text += f'https://t.bilibili.com/{dynamic_id}'
 
-        photos = await self._download_photos(tweet)
         if tweet.type == 'quoted':
-            referenced_photos = await self._download_photos(tweet.referenced_tweet)
+            # 两条推的图片同时下载
+            photos, referenced_photos = await asyncio.gather(
+                self._download_photos(tweet), self._download_photos(tweet.referenced_tweet))
             if referenced_photos:
                 img = photos + [self.gap_img] + referenced_photos
             else:
                 img = photos
         else:
-            img = photos
+            img = await self._download_photos(tweet)
 
-        response = await self.sender.send(text=text, image_streams=img)
-        self.save_forward_info(tweet, response['dynamic_id'])
+        account = self.get_account(tweet)
+        response = await account.scheduler.send(text=text, image_streams=img)
+        self.save_forward_info(tweet, response['dynamic_id'],
+                               account.sender.comment_target_of_sent(response, bool(img)))
 
+    @tracer.traced('repost')
     async def on_repost(self, tweet: Tweet, dynamic_id: int):
         text = '{}于{}转发了此条推：\n{}'.format(
             self.listener.get_author_name(tweet.author),
-            tweet.get_create_time(self.display_timezone).strftime(
-                '%Y-%m-%d %H:%M:%S'),
+            tweet.format_create_time(self.display_timezone),
             tweet.parse_text())
         if len(text) > 233:
             # 超过转发字数限制
             # 由于动态转发API不会返回动态id，所以只能退而重发一条
             await self.on_send_dynamic(tweet, dynamic_id)
         else:
-            await self.sender.repost_dynamic(text=text, dynamic_id=dynamic_id)
+            await self.get_account(tweet).scheduler.repost_dynamic(text=text, dynamic_id=dynamic_id)
+            self.save_forward_marker(tweet, 'repost')
 
-    async def on_comment(self, tweet: Tweet, dynamic_id: int):
+    @tracer.traced('comment')
+    async def on_comment(self, tweet: Tweet, dynamic_id: int) -> Optional[asyncio.Future]:
+        """
+        开启评论合并时不等待发送，返回评论发出后完成的Future
+        """
         text = '{}于{}评论：\n{}'.format(
             self.listener.get_author_name(tweet.author),
-            tweet.get_create_time(self.display_timezone).strftime(
-                '%Y-%m-%d %H:%M:%S'),
+            tweet.format_create_time(self.display_timezone),
             tweet.parse_text())
-        await self.sender.send_comment(text=text, dynamic_id=dynamic_id)
+        account = self.get_account(tweet)
+        target = self.get_comment_target(tweet.referenced_tweet.id, account)
+        if account.coalescer is not None:
+            self._queued_comments[tweet.id] = (dynamic_id, target)
+            return account.coalescer.add(text=text, dynamic_id=dynamic_id, target=target)
+        await account.scheduler.send_comment(text=text, dynamic_id=dynamic_id, target=target)
+        # 记为转发到父推文所在的动态，回复这条推文的推文也评论到那里
+        self.save_forward_info(tweet, dynamic_id, target)
+        return None
+
+    def _finish(self, tweet: Tweet, action: str, result: str, start: float):
+        metrics.inc('t2b_tweets_total', action=action, result=result)
+        metrics.observe('t2b_forward_seconds', time.monotonic() - start, action=action)
+        # 没有转发成功的推文也要唤醒等待它的推文
+        self.in_flight.resolve(tweet.id, None)
+        # 进程在处理中途退出的推文不标记，下次启动时重放
+        self.outbox.mark_done(tweet.id)
+        tracer.end(self._traces.pop(tweet.id, None), action=action, result=result)
+
+    def _on_coalesced_comment_done(self, tweet: Tweet, start: float, future: asyncio.Future):
+        dynamic_id, target = self._queued_comments.pop(tweet.id)
+        if future.cancelled():
+            # 退出时还没发出，下次启动时重放
+            return
+        error = future.exception()
+        if error is None:
+            result = 'forwarded'
+            self.save_forward_info(tweet, dynamic_id, target)
+            logger.info(f'Forwarded tweet id {tweet.id}, action: comment')
+        else:
+            result = 'error'
+            if isinstance(error, bili_exceptions.ResponseCodeException):
+                logger.error(f'Bilibili Error {error.code} on tweet id {tweet.id}, return data: {error.raw}')
+            else:
+                logger.error(f'Error on tweet id {tweet.id}: {error}')
+        self._finish(tweet, 'comment', result, start)
 
     async def handler(self, tweet: Tweet):
+        action, result = 'unknown', 'error'
+        start = time.monotonic()
+        trace = tracer.current()
+        if trace is not None:
+            trace.set(queue_seconds=round(trace.elapsed, 6))
         try:
-            action, dynamic_id = self.get_forward_action(tweet)
+            action, dynamic_id = await self.get_forward_action(tweet)
             if action == 'send':
                 await self.on_send_dynamic(tweet, dynamic_id)
             elif action == 'repost':
                 await self.on_repost(tweet, dynamic_id)
             elif action == 'comment':
-                await self.on_comment(tweet, dynamic_id)
+                pending = await self.on_comment(tweet, dynamic_id)
+                if pending is not None:
+                    # 合并的评论在窗口结束后才发出，发出后再记录结果。
+                    # 回复它的推文现在就可以加入同一条动态下的合并
+                    self.in_flight.resolve(tweet.id, dynamic_id)
+                    pending.add_done_callback(partial(self._on_coalesced_comment_done, tweet, start))
+                    return
         except AbortForwarding:
+            result = 'aborted'
             logger.debug(f'Aborted tweet id {tweet.id}')
         except TwitterAPIException as e:
             logger.error(f'Twitter API error {e.code} on tweet id {tweet.id}: {e.data}')
-        except BiliCodeException as e:
+        except bili_exceptions.ResponseCodeException as e:
             logger.error(f'Bilibili Error {e.code} on tweet id {tweet.id}, return data: {e.raw}')
         except Exception as e:
             logger.error(f'Error on tweet id {tweet.id}: {e}')
         else:
+            result = 'forwarded'
             logger.info(f'Forwarded tweet id {tweet.id}, action: {action}')
+        self._finish(tweet, action, result, start)
+
+    async def deduplicated_handler(self, tweet: Tweet):
+        # 处理推文的任务在run_once中创建，继承这里设置的trace
+        with tracer.activate(self._traces.get(tweet.id, None)):
+            await self.deduplicator.run_once(tweet.id, partial(self.handler, tweet))
+
+    def on_stream_connected(self, listener: TwitterListener):
+        if 'stream_connected' not in self.startup.marks:
+            self.startup.mark('stream_connected')
+            self.startup.log()
+            self._prepare_task = asyncio.ensure_future(self.prepare_bili())
+        if self.backfiller is not None:
+            self.backfiller.start(self.receive, self.query)
+
+    async def receive(self, tweet: Tweet):
+        if not self.deduplicator.check(tweet.id):
+            logger.debug(f'Suppressed duplicate tweet id {tweet.id}')
+            return
+        if self.backfiller is not None:
+            self.backfiller.record(tweet)
+        if not self.outbox.add(tweet):
+            logger.debug(f'Tweet id {tweet.id} is already in outbox')
+            return
+        await self._enqueue(tweet)
+
+    async def _enqueue(self, tweet: Tweet, **trace_attributes):
+        trace = tracer.start_trace('tweet', tweet_id=tweet.id, type=tweet.type, **trace_attributes)
+        if trace is not None:
+            if tweet.author is not None:
+                trace.set(author=tweet.author.username)
+            self._traces[tweet.id] = trace
+        self.in_flight.register(tweet.id)
+        if not await self.queue.put(tweet):
+            self.in_flight.resolve(tweet.id, None)
+            tracer.end(self._traces.pop(tweet.id, None), result='dropped')
+
+    async def replay_outbox(self):
+        tweets = self.outbox.pending()
+        if tweets:
+            logger.info(f'Replaying {len(tweets)} unfinished tweets from outbox')
+        for tweet in tweets:
+            self.deduplicator.add(tweet.id)
+            if self.get_account(tweet).forward_store.get(tweet.id) is not None:
+                # 已经发出（包括评论和转发），只是没来得及标记
+                self.outbox.mark_done(tweet.id)
+            else:
+                await self._enqueue(tweet, replayed=True)
+
+    async def start(self):
+        """
+        启动处理推文所需的后台任务，之后可以调用receive
+        """
+        if self.metrics_server is not None:
+            await self.metrics_server.start()
+        self.outbox.start()
+        self.queue.start()
+
+    async def stop(self):
+        if self._prepare_task is not None and not self._prepare_task.done():
+            self._prepare_task.cancel()
+        if self.backfiller is not None:
+            await self.backfiller.stop()
+            logger.info(f'Backfill stats: {self.backfiller.stats}')
+        await self.queue.stop()
+        await asyncio.gather(*[account.stop() for account in self.accounts.values()])
+        if self.__dict__.get('image_cache', None) is not None:
+            await self.image_cache.stop()
+        await self.outbox.close()
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+        await session_manager.close()
+        if self.image_processor is not None:
+            self.image_processor.close()
+            logger.info(f'Image processor stats: {self.image_processor.stats}')
+        logger.info(f'Tweet queue stats: {self.queue.stats}')
+        for name, account in self.accounts.items():
+            if not account.loaded:
+                continue
+            logger.info(f'Account {name} send scheduler stats: {account.scheduler.stats}')
+            logger.info(f'Account {name} image upload stats: {account.sender.upload_stats}')
+            if account.coalescer is not None:
+                logger.info(f'Account {name} comment coalescer stats: {account.coalescer.stats}')
+        logger.info(f'Referenced tweet wait stats: {self.in_flight.stats}')
+        logger.info(f'Duplicate suppression stats: {self.deduplicator.stats}')
+        if tracer.enabled:
+            logger.info(f'Tracing stats: {tracer.stats}')
+        self.profiler.stop()
+
+    async def _run(self):
+        with self.startup.phase('start'):
+            await self.start()
+        watcher = None
+        if self.config_watch_interval is not None:
+            watcher = asyncio.ensure_future(self._watch_config())
+        try:
+            with self.startup.phase('replay_outbox'):
+                await self.replay_outbox()
+            await self.listener.listen(self.listener_initializer, self.query, self.receive,
+                                       on_connected=self.on_stream_connected)
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+            await self.stop()
+
+    def close(self):
+        for account in self.accounts.values():
+            account.close()
+        # 没有用到时不创建
+        if self.__dict__.get('image_cache', None) is not None:
+            self.image_cache.close()
+        tracer.close()
 
     def run(self):
         loop = asyncio.get_event_loop()
-        task = asyncio.ensure_future(self.listener.listen(
-            self.listener_initializer, self.query, self.handler))
+        task = asyncio.ensure_future(self._run())
         # Ctrl C退出
         for signal in [SIGINT, SIGTERM]:
             loop.add_signal_handler(signal, task.cancel)
-        loop.run_until_complete(task)
+        # kill -HUP重新加载配置
+        loop.add_signal_handler(SIGHUP, lambda: asyncio.ensure_future(self.reload_config()))
+        # kill -USR1开始或停止事件循环的采样分析
+        loop.add_signal_handler(SIGUSR1, self.profiler.toggle)
+        try:
+            loop.run_until_complete(task)
+        finally:
+            self.close()
@@ -0,0 +1,150 @@
+"""
+上传前的图片预处理：缩小尺寸、重新压缩、去掉元数据。
+处理在进程池里进行，不阻塞事件循环；没有安装Pillow时原样返回
+"""
+import io
+import time
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit, parse_qsl, urlencode
+from loguru import logger
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+from typing import Dict, List, Optional, Tuple
+
+
+# pbs.twimg.com的图片尺寸档位，值为该档位的最长边上限
+TWITTER_SIZE_VARIANTS = (('small', 680), ('medium', 1200), ('large', 2048), ('4096x4096', 4096))
+
+# 这些信息会泄露拍摄设备等信息或者只是占体积，重新编码时不保留
+_METADATA_KEYS = ('exif', 'comment', 'xmp', 'XML:com.adobe.xmp', 'photoshop')
+
+
+def photo_variant_url(url: str, max_dimension: int) -> str:
+    """
+    推特图片链接换成不小于max_dimension的最小尺寸档位，不是推特图片的链接原样返回
+    """
+    parts = urlsplit(url)
+    if parts.netloc != 'pbs.twimg.com' or not parts.path.startswith('/media/'):
+        return url
+    name = 'orig'
+    for variant, size in TWITTER_SIZE_VARIANTS:
+        if size >= max_dimension:
+            name = variant
+            break
+    path, _, extension = parts.path.rpartition('.')
+    query = dict(parse_qsl(parts.query))
+    if path and 'format' not in query:
+        query['format'] = extension
+    else:
+        path = parts.path
+    query['name'] = name
+    return parts._replace(path=path, query=urlencode(query)).geturl()
+
+
+def _encode(image: 'Image.Image', format: str, quality: int) -> bytes:
+    buffer = io.BytesIO()
+    if format == 'PNG':
+        image.save(buffer, format='PNG', optimize=True)
+    else:
+        image.save(buffer, format='JPEG', quality=quality, optimize=True, progressive=True)
+    return buffer.getvalue()
+
+
+def process_image(data: bytes, max_dimension: int, quality: int, max_bytes: int) -> bytes:
+    """
+    在进程池中运行。尺寸、体积都在限制内且没有元数据的图片原样返回，避免重复压缩损失画质
+    """
+    image = Image.open(io.BytesIO(data))
+    if getattr(image, 'is_animated', False):
+        return data
+    needs_resize = max(image.size) > max_dimension
+    has_metadata = any(key in image.info for key in _METADATA_KEYS) or bool(image.getexif())
+    if not needs_resize and not has_metadata and len(data) <= max_bytes:
+        return data
+
+    # 先按EXIF方向转正，之后EXIF就不需要了
+    image = ImageOps.exif_transpose(image)
+    has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+    format = 'PNG' if has_alpha else 'JPEG'
+    image = image.convert('RGBA' if has_alpha else 'RGB')
+    if needs_resize:
+        image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+
+    output = _encode(image, format, quality)
+    # 还是太大就先降低质量，再缩小尺寸
+    while len(output) > max_bytes:
+        if format == 'JPEG' and quality > 60:
+            quality -= 10
+        elif min(image.size) > 64:
+            image = image.resize((image.width * 3 // 4, image.height * 3 // 4), Image.LANCZOS)
+        else:
+            break
+        output = _encode(image, format, quality)
+    return output
+
+
+class ImageProcessor:
+    def __init__(self, max_dimension: int = 2048, quality: int = 85,
+                 max_bytes: int = 10 << 20, workers: int = 2) -> None:
+        self.max_dimension = max_dimension
+        self.quality = quality
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.enabled = Image is not None
+        if not self.enabled:
+            logger.warning('Pillow is not installed, photos will be uploaded without preprocessing')
+
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self.stats = {'images': 0, 'failed': 0, 'bytes_in': 0, 'bytes_out': 0, 'seconds': 0.0}
+
+    def variant_url(self, url: str) -> str:
+        return photo_variant_url(url, self.max_dimension) if self.enabled else url
+
+    async def process(self, data: bytes) -> bytes:
+        if not self.enabled:
+            return data
+        if self._executor is None:
+            # 这时已经有线程池等线程在运行，fork可能复制到被其他线程持有的锁（如loguru的）而死锁
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('forkserver')
+                # 默认会在forkserver里预先导入__main__
+                context.set_forkserver_preload(['twitter2bilibili.image'])
+            else:
+                context = multiprocessing.get_context('spawn')
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=context)
+        loop = asyncio.get_event_loop()
+        try:
+            output = await loop.run_in_executor(
+                self._executor, process_image, data, self.max_dimension, self.quality, self.max_bytes)
+        except Exception as e:
+            # 无法识别的图片交给B站判断
+            logger.warning(f'Failed to process image of {len(data)} bytes: {e!r}')
+            self.stats['failed'] += 1
+            return data
+        self.stats['images'] += 1
+        self.stats['bytes_in'] += len(data)
+        self.stats['bytes_out'] += len(output)
+        return output
+
+    async def process_all(self, images: List[bytes]) -> Tuple[List[bytes], Dict]:
+        """
+        Returns:
+            (处理后的图片, 本次处理的字节数和耗时)
+        """
+        start = time.monotonic()
+        outputs = list(await asyncio.gather(*[self.process(data) for data in images]))
+        seconds = time.monotonic() - start
+        self.stats['seconds'] += seconds
+        return outputs, {'bytes_in': sum(map(len, images)), 'bytes_out': sum(map(len, outputs)),
+                         'seconds': seconds}
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,50 @@
+import asyncio
+from loguru import logger
+
+from typing import Dict, Optional
+
+
+class InFlightRegistry:
+    """
+    已收到但还没转发完的推文。推文id -> 转发后得到的动态id（Future），
+    回复或引用了这些推文的推文可以等父推文发出后拿到动态id，而不是因为查不到转发记录被丢弃或重复发送
+    """
+
+    def __init__(self, timeout: float = 60) -> None:
+        self.timeout = timeout
+        self._futures: Dict[str, asyncio.Future] = {}
+        self.stats = {'waited': 0, 'resolved': 0, 'timeouts': 0}
+
+    def __contains__(self, tweet_id) -> bool:
+        return str(tweet_id) in self._futures
+
+    def register(self, tweet_id):
+        tweet_id = str(tweet_id)
+        if tweet_id not in self._futures:
+            self._futures[tweet_id] = asyncio.get_event_loop().create_future()
+
+    def resolve(self, tweet_id, dynamic_id: Optional[int]):
+        """
+        推文转发完成（dynamic_id为动态id）或放弃（dynamic_id为None），唤醒等待它的推文
+        """
+        future = self._futures.pop(str(tweet_id), None)
+        if future is not None and not future.done():
+            future.set_result(dynamic_id)
+
+    async def wait(self, tweet_id) -> Optional[int]:
+        """
+        等待推文转发完成，返回其动态id。推文不在转发中、被放弃或等待超时都返回None
+        """
+        future = self._futures.get(str(tweet_id), None)
+        if future is None:
+            return None
+        self.stats['waited'] += 1
+        try:
+            dynamic_id = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            self.stats['timeouts'] += 1
+            logger.warning(f'Timed out waiting for tweet id {tweet_id} to be forwarded')
+            return None
+        if dynamic_id is not None:
+            self.stats['resolved'] += 1
+        return dynamic_id
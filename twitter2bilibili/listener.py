@@ -1,16 +1,30 @@
 import json
+import time
 import asyncio
 from loguru import logger
 
-from .tweet import Tweet, TwitterUser
+from .metrics import metrics
+from .recorder import StreamRecorder
+from .supervisor import ConnectionSupervisor, StreamStalled
+from .tweet import Tweet, TwitterUser, TweetIncludes
 from .twitter_api import TwitterAPI, TwitterAPIException, ClientResponse
+from aiohttp import ClientTimeout
 
-from typing import Dict, List, Coroutine, Callable
+from typing import Dict, List, Coroutine, Callable, Optional
 
 
 class TwitterListener:
-    def __init__(self, api: TwitterAPI, subscribe_users: List[Dict]) -> None:
+    def __init__(self, api: TwitterAPI, subscribe_users: List[Dict],
+                 supervisor: Optional[ConnectionSupervisor] = None, connect_timeout: float = 30,
+                 recorder: Optional[StreamRecorder] = None) -> None:
+        """
+        Args:
+            recorder (StreamRecorder, optional): 记录stream收到的原始数据，用于事后重放
+        """
         self.api = api
+        self.recorder = recorder
+        self.supervisor = supervisor if supervisor is not None else ConnectionSupervisor()
+        self.connect_timeout = connect_timeout
 
         self.subscribe_users: Dict[str, Dict] = {
             user['username']: user for user in subscribe_users}
@@ -18,10 +32,20 @@ class TwitterListener:
         self.rules: List[Dict] = []
         self.not_gotten_rules: bool = True
 
-    def _make_rules(self, tag) -> Dict:
-        rule_value = ' OR '.join([
-            'from:'+user['username'] for user in self.subscribe_users.values()])
-        return [{'value': rule_value, 'tag': tag}]
+        self.connect_count = 0
+        self.last_receive_time: float = time.monotonic()
+
+    @property
+    def idle_seconds(self) -> float:
+        return time.monotonic() - self.last_receive_time
+
+    def update_subscribe_users(self, subscribe_users: List[Dict]):
+        # 原地更新，已经持有这个字典的地方也能看到变化
+        new_users = {user['username']: user for user in subscribe_users}
+        for username in list(self.subscribe_users):
+            if username not in new_users:
+                del self.subscribe_users[username]
+        self.subscribe_users.update(new_users)
 
     async def get_rules(self) -> List[Dict]:
         self.rules = (await self.api.get_stream_rules()).get('data', [])
@@ -36,9 +60,13 @@ class TwitterListener:
         self.rules = [rule for rule in self.rules if rule['id'] not in ids]
 
     async def add_rules(self, rules: List[Dict]):
+        if not rules:
+            return
         payload = {'add': rules}
         response = await self.api.set_stream_rules(payload)
-        self.rules.extend(response['data'])
+        if 'errors' in response:
+            logger.error(f'Errors on adding rules: {response["errors"]}')
+        self.rules.extend(response.get('data', []))
 
     def get_author_name(self, author:TwitterUser):
         if author.username in self.subscribe_users:
@@ -52,45 +80,82 @@ class TwitterListener:
         tweet_dicts = tweets_response['data']
         if isinstance(tweet_dicts, dict):
             tweet_dicts = [tweet_dicts]
-        tweets = [Tweet(
-            **d, tweet_includes=tweets_response['includes']) for d in tweet_dicts]
+        # 同一次响应中的推文共用includes索引，被多次引用的对象只构造一次
+        includes = TweetIncludes(tweets_response.get('includes', {}))
+        tweets = [Tweet(**d, tweet_includes=includes) for d in tweet_dicts]
         return tweets
 
-    async def _try_connect_until_succeed(self, query: Dict, retry_interval: float = 300) -> ClientResponse:
+    async def _try_connect_until_succeed(self, query: Dict) -> ClientResponse:
         while True:
             try:
-                response = await self.api.get_filtered_stream(query)
+                response = await self.api.get_filtered_stream(
+                    query, timeout=ClientTimeout(total=None, connect=self.connect_timeout))
             except TwitterAPIException as e:
                 logger.error(f'Connect failed due to twitter error {e.code}: {e.data}')
+                metrics.inc('t2b_stream_connect_failures_total', reason=e.code)
+                delay = self.supervisor.on_failure(e)
             except Exception as e:
                 logger.error(f'Connect failed due to error: {e}')
+                metrics.inc('t2b_stream_connect_failures_total', reason='network')
+                delay = self.supervisor.on_failure(e)
             else:
                 logger.info('Connected.')
+                self.connect_count += 1
+                self.last_receive_time = time.monotonic()
+                self.supervisor.on_connected()
                 return response
 
-            # 推特filtered stream同时只允许一个连接，客户端断开之后在连接在服务端会保持一段时间，故睡一段时间再尝试重连
-            # 间隔时间过短会导致尝试总时间拉长（原因不明），经测试间隔300s不会多次重连
-            await asyncio.sleep(retry_interval)
+            # 推特filtered stream同时只允许一个连接，客户端断开之后连接在服务端会保持一段时间，
+            # 此时重连会得到429，由supervisor按失败类型退避
+            await asyncio.sleep(delay)
+
+    async def process_line(self, response_line: bytes, tweet_handler: Callable[[Tweet], Coroutine]) -> bool:
+        """
+        解析stream的一行并交给tweet_handler，收到filtered stream的错误时返回False
+        """
+        metrics.inc('t2b_stream_bytes_total', len(response_line))
+        with metrics.timer('t2b_stage_seconds', stage='parse'):
+            tweets_response = json.loads(response_line)
+        if 'errors' in tweets_response:
+            logger.error(f'Filtered stream error:\n{tweets_response["errors"]}')
+            return False
+
+        try:
+            with metrics.timer('t2b_stage_seconds', stage='split'):
+                tweets = self._split_tweets_response(tweets_response)
+            metrics.inc('t2b_stream_tweets_total', len(tweets))
+            with metrics.timer('t2b_stage_seconds', stage='enqueue'):
+                await asyncio.gather(*[tweet_handler(tweet) for tweet in tweets])
+        except Exception as e:
+            logger.error(f'Error {e} on response:\n {tweets_response}')
+        return True
 
     async def listen(self, initialize: Callable[['TwitterListener'], Coroutine], query: Dict,
-                     tweet_handler: Callable[[Tweet], Coroutine]):
+                     tweet_handler: Callable[[Tweet], Coroutine],
+                     on_connected: Optional[Callable[['TwitterListener'], None]] = None):
         await initialize(self)
         while True:
             response = await self._try_connect_until_succeed(query)
+            if on_connected is not None:
+                on_connected(self)
+            delay = 0.0
             try:
-                async for response_line in response.content:
+                async for response_line in self.supervisor.read_lines(response):
+                    self.last_receive_time = time.monotonic()
                     if response_line != b'\r\n':  # '\r\n'为filtered stream的keep alive信号
-                        tweets_response = json.loads(response_line)
-                        if 'errors' in tweets_response:
-                            logger.error(f'Filtered stream error:\n{tweets_response["errors"]}')
+                        if self.recorder is not None:
+                            self.recorder.record(response_line)
+                        if not await self.process_line(response_line, tweet_handler):
+                            delay = self.supervisor.on_failure(ConnectionError('filtered stream error'))
                             break
-
-                        try:
-                            tweets = self._split_tweets_response(tweets_response)
-                            await asyncio.gather(*[tweet_handler(tweet) for tweet in tweets])
-                        except Exception as e:
-                            logger.error(f'Error {e} on response:\n {tweets_response}')
+            except StreamStalled as e:
+                logger.warning(f'Stream stalled: {e}, reconnecting')
+                metrics.inc('t2b_stream_stalls_total')
+                delay = self.supervisor.on_failure(e)
             except Exception as e:
                 logger.error(f'Connection closed due to error: {e}')
+                delay = self.supervisor.on_failure(e)
             finally:
-                response.release()
+                # 卡死的连接不能放回连接池
+                response.close()
+            await asyncio.sleep(delay)
@@ -0,0 +1,211 @@
+import os
+import random
+import asyncio
+import hashlib
+from collections import OrderedDict
+from loguru import logger
+
+import aiohttp
+
+from .utils.network import get_session
+
+from typing import Dict, List, Optional
+
+
+class MediaTooLarge(Exception):
+    def __init__(self, url: str, max_bytes: int) -> None:
+        super().__init__(f'media {url} is larger than {max_bytes} bytes')
+        self.url = url
+        self.max_bytes = max_bytes
+
+
+class MediaDownloadError(Exception):
+    def __init__(self, url: str, status: int) -> None:
+        super().__init__(f'download {url} failed with HTTP {status}')
+        self.url = url
+        self.status = status
+
+
+class MediaCache:
+    """
+    以URL为key的两级LRU缓存：内存一级和磁盘一级各自有字节数上限，
+    内存淘汰的内容仍留在磁盘上，磁盘命中时重新提升到内存
+    """
+
+    def __init__(self, memory_bytes: int = 64 << 20, disk_dir: Optional[str] = None,
+                 disk_bytes: int = 512 << 20) -> None:
+        self.memory_bytes = memory_bytes
+        self.disk_dir = disk_dir
+        self.disk_bytes = disk_bytes
+
+        self._memory: 'OrderedDict[str, bytes]' = OrderedDict()
+        self._memory_size = 0
+        self._disk: 'OrderedDict[str, int]' = OrderedDict()  # 文件名 -> 字节数
+        self._disk_size = 0
+        if self.disk_dir is not None:
+            self._load_disk_index()
+
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+
+    @staticmethod
+    def _key(url: str) -> str:
+        return hashlib.sha1(url.encode()).hexdigest()
+
+    def _load_disk_index(self):
+        os.makedirs(self.disk_dir, exist_ok=True)
+        entries = []
+        for name in os.listdir(self.disk_dir):
+            path = os.path.join(self.disk_dir, name)
+            if name.endswith('.tmp'):
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._disk[name] = size
+            self._disk_size += size
+
+    def _put_memory(self, key: str, data: bytes):
+        if len(data) > self.memory_bytes:
+            return
+        if key in self._memory:
+            self._memory_size -= len(self._memory.pop(key))
+        self._memory[key] = data
+        self._memory_size += len(data)
+        while self._memory_size > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    def _read_disk(self, key: str) -> Optional[bytes]:
+        try:
+            with open(os.path.join(self.disk_dir, key), 'rb') as f:
+                data = f.read()
+            os.utime(os.path.join(self.disk_dir, key))
+            return data
+        except OSError:
+            return None
+
+    def _write_disk(self, key: str, data: bytes):
+        path = os.path.join(self.disk_dir, key)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+
+    def _remove_disk(self, key: str):
+        try:
+            os.remove(os.path.join(self.disk_dir, key))
+        except OSError:
+            pass
+
+    async def get(self, url: str) -> Optional[bytes]:
+        key = self._key(url)
+        data = self._memory.get(key, None)
+        if data is not None:
+            self._memory.move_to_end(key)
+            self.stats['memory_hits'] += 1
+            return data
+
+        if key in self._disk:
+            data = await asyncio.get_event_loop().run_in_executor(None, self._read_disk, key)
+            # 读取期间并发的put可能已经把它淘汰了
+            if data is not None:
+                if key in self._disk:
+                    self._disk.move_to_end(key)
+                self._put_memory(key, data)
+                self.stats['disk_hits'] += 1
+                return data
+            self._disk_size -= self._disk.pop(key, 0)
+
+        self.stats['misses'] += 1
+        return None
+
+    async def put(self, url: str, data: bytes):
+        key = self._key(url)
+        self._put_memory(key, data)
+        if self.disk_dir is None or len(data) > self.disk_bytes or key in self._disk:
+            return
+
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._write_disk, key, data)
+        if key in self._disk:
+            # 写入期间同一个key已经被并发的put记录
+            return
+        self._disk[key] = len(data)
+        self._disk_size += len(data)
+        while self._disk_size > self.disk_bytes:
+            evicted_key, size = self._disk.popitem(last=False)
+            self._disk_size -= size
+            await loop.run_in_executor(None, self._remove_disk, evicted_key)
+
+
+class MediaFetcher:
+    """
+    媒体下载：全局并发上限、流式读取时检查大小上限、失败时指数退避重试，
+    同一URL的并发下载合并为一次，下载结果存入MediaCache
+    """
+
+    def __init__(self, cache: Optional[MediaCache] = None, max_concurrency: int = 8,
+                 max_bytes: int = 20 << 20, retries: int = 3, backoff: float = 1.0,
+                 chunk_size: int = 64 << 10) -> None:
+        self.cache = cache
+        self.max_bytes = max_bytes
+        self.retries = retries
+        self.backoff = backoff
+        self.chunk_size = chunk_size
+
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._in_flight: Dict[str, asyncio.Future] = {}
+
+    async def _download(self, url: str) -> bytes:
+        session = get_session('media')
+        async with self._semaphore:
+            async with session.get(url) as response:
+                if response.status != 200:
+                    raise MediaDownloadError(url, response.status)
+                if (response.content_length or 0) > self.max_bytes:
+                    raise MediaTooLarge(url, self.max_bytes)
+
+                data = bytearray()
+                async for chunk in response.content.iter_chunked(self.chunk_size):
+                    data.extend(chunk)
+                    if len(data) > self.max_bytes:
+                        raise MediaTooLarge(url, self.max_bytes)
+                return bytes(data)
+
+    async def _download_with_retry(self, url: str) -> bytes:
+        for attempt in range(self.retries + 1):
+            try:
+                return await self._download(url)
+            except MediaDownloadError as e:
+                # 4xx（429除外）重试也没用
+                if 400 <= e.status < 500 and e.status != 429 or attempt == self.retries:
+                    raise
+                error = e
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == self.retries:
+                    raise
+                error = e
+            delay = self.backoff * 2 ** attempt * (1 + random.random())
+            logger.warning(f'Download {url} failed ({error!r}), retry in {delay:.1f}s')
+            await asyncio.sleep(delay)
+
+    async def _fetch(self, url: str) -> bytes:
+        if self.cache is not None:
+            data = await self.cache.get(url)
+            if data is not None:
+                return data
+        data = await self._download_with_retry(url)
+        if self.cache is not None:
+            await self.cache.put(url, data)
+        return data
+
+    async def fetch(self, url: str) -> bytes:
+        future = self._in_flight.get(url, None)
+        if future is None:
+            future = asyncio.ensure_future(self._fetch(url))
+            self._in_flight[url] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(url, None))
+        return await asyncio.shield(future)
+
+    async def fetch_all(self, urls: List[str]) -> List[bytes]:
+        return list(await asyncio.gather(*[self.fetch(url) for url in urls]))
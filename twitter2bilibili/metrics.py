@@ -0,0 +1,199 @@
+"""
+计数器、延迟直方图和gauge，以Prometheus文本格式通过本地HTTP端口输出。
+metrics.enabled为False（没有配置metrics_port）时所有记录函数直接返回，几乎没有开销
+"""
+import time
+import bisect
+from loguru import logger
+
+from .startup import LazyModule
+
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# 只在开启MetricsServer时用到
+web = LazyModule('aiohttp.web')
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+class _Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets: Tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self.enabled = False
+        self._counters: Dict[str, Dict[LabelKey, float]] = {}
+        self._histograms: Dict[str, Dict[LabelKey, _Histogram]] = {}
+        self._gauges: Dict[str, Callable[[], float]] = {}
+        self._help: Dict[str, str] = {}
+
+    @staticmethod
+    def _labels(labels: Dict) -> LabelKey:
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def describe(self, name: str, help_text: str):
+        self._help[name] = help_text
+
+    def inc(self, name: str, value: float = 1, **labels):
+        if not self.enabled:
+            return
+        series = self._counters.setdefault(name, {})
+        key = self._labels(labels)
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        if not self.enabled:
+            return
+        series = self._histograms.setdefault(name, {})
+        key = self._labels(labels)
+        histogram = series.get(key, None)
+        if histogram is None:
+            histogram = series[key] = _Histogram(DEFAULT_BUCKETS)
+        histogram.observe(value)
+
+    def gauge(self, name: str, func: Callable[[], float]):
+        """
+        注册gauge，func在每次输出时被调用取值
+        """
+        self._gauges[name] = func
+
+    def timer(self, name: str, **labels) -> '_Timer':
+        return _Timer(self, name, labels) if self.enabled else _NULL_TIMER
+
+    @staticmethod
+    def _format_labels(key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+        items = list(key) + ([extra] if extra is not None else [])
+        if not items:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in items) + '}'
+
+    def render(self) -> str:
+        lines: List[str] = []
+
+        def header(name: str, type_: str):
+            if name in self._help:
+                lines.append(f'# HELP {name} {self._help[name]}')
+            lines.append(f'# TYPE {name} {type_}')
+
+        for name, series in self._counters.items():
+            header(name, 'counter')
+            for key, value in series.items():
+                lines.append(f'{name}{self._format_labels(key)} {value}')
+        for name, series in self._histograms.items():
+            header(name, 'histogram')
+            for key, histogram in series.items():
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{self._format_labels(key, ("le", str(bound)))} {cumulative}')
+                lines.append(f'{name}_bucket{self._format_labels(key, ("le", "+Inf"))} {histogram.count}')
+                lines.append(f'{name}_sum{self._format_labels(key)} {histogram.sum}')
+                lines.append(f'{name}_count{self._format_labels(key)} {histogram.count}')
+        for name, func in self._gauges.items():
+            header(name, 'gauge')
+            try:
+                lines.append(f'{name} {func()}')
+            except Exception as e:
+                logger.error(f'Failed to read gauge {name}: {e}')
+        return '\n'.join(lines) + '\n'
+
+
+class _Timer:
+    __slots__ = ('metrics', 'name', 'labels', 'start')
+
+    def __init__(self, metrics: Metrics, name: str, labels: Dict) -> None:
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self) -> '_Timer':
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.monotonic() - self.start, **self.labels)
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+# 输出为# HELP行的说明
+HELP = {
+    't2b_tweets_total': 'Tweets handled, by forward action and result',
+    't2b_forward_seconds': 'Time from receiving a tweet to finishing its forward',
+    't2b_stage_seconds': 'Time spent in each processing stage',
+    't2b_photo_bytes_total': 'Bytes of photos downloaded from Twitter',
+    't2b_photo_bytes_saved_total': 'Bytes saved by processing photos before upload',
+    't2b_comments_merged_total': 'Comments merged into an earlier comment',
+    't2b_duplicates_suppressed_total': 'Tweets not forwarded because they were duplicates',
+    't2b_backfill_tweets_total': 'Tweets found by backfill after a stream disconnect',
+    't2b_bilibili_request_seconds': 'Latency of bilibili API requests',
+    't2b_bilibili_errors_total': 'bilibili API requests that failed with a response code',
+    't2b_bilibili_upload_cache_hits_total': 'Image uploads skipped by the upload cache',
+    't2b_stream_bytes_total': 'Bytes received from the filtered stream',
+    't2b_stream_tweets_total': 'Tweets received from the filtered stream',
+    't2b_stream_connect_failures_total': 'Failed filtered stream connection attempts',
+    't2b_stream_stalls_total': 'Filtered stream connections dropped for missing keep-alives',
+    't2b_stream_connects': 'Filtered stream connections made since start',
+    't2b_stream_idle_seconds': 'Seconds since the last data from the filtered stream',
+    't2b_stream_keep_alive_interval_seconds': 'Observed keep-alive interval of the filtered stream',
+    't2b_queue_depth': 'Tweets waiting to be forwarded',
+    't2b_queue_overflowed': 'Tweets dropped because the tweet queue was full',
+    't2b_queue_backpressure_seconds': 'Seconds the stream reader waited on a full tweet queue',
+    't2b_send_queue_depth': 'Requests waiting in the bilibili send queues',
+    't2b_send_rate': 'Adaptive bilibili send rate of all accounts, requests per second',
+}
+
+metrics = Metrics()
+for _name, _help_text in HELP.items():
+    metrics.describe(_name, _help_text)
+
+
+class MetricsServer:
+    def __init__(self, registry: Metrics = metrics, host: str = '127.0.0.1', port: int = 9108) -> None:
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._runner: Optional['web.AppRunner'] = None
+
+    async def _handle(self, request: 'web.Request') -> 'web.Response':
+        return web.Response(text=self.registry.render(), content_type='text/plain', charset='utf-8')
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/metrics', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f'Serving metrics on http://{self.host}:{self.port}/metrics')
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,144 @@
+import os
+import json
+import asyncio
+from collections import OrderedDict
+from loguru import logger
+
+from .tweet import Tweet
+
+from typing import Dict, List, Optional
+
+
+class Outbox:
+    """
+    收到但尚未处理完的推文的持久化记录，进程重启后可以重放。
+
+    追加写日志，每行为{"op": "add", "key": ..., "payload": ...}或{"op": "done", "key": ...}。
+    写入先进入内存缓冲，由后台任务每flush_interval秒合并写入并fsync一次，
+    所以add/mark_done不会阻塞处理推文。推文id作为幂等key，已记录或已完成的推文不会再次加入
+    """
+
+    def __init__(self, path: str = 'outbox.jsonl', flush_interval: float = 0.2,
+                 max_done_keys: int = 10000, compact_threshold: int = 1000) -> None:
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_done_keys = max_done_keys
+        self.compact_threshold = compact_threshold
+
+        self._pending: 'OrderedDict[str, Dict]' = OrderedDict()
+        self._done: 'OrderedDict[str, None]' = OrderedDict()
+        self._buffer: List[str] = []
+        self._log_lines = 0
+        self._file = None
+        self._flusher: Optional[asyncio.Task] = None
+        self._flushing: Optional[asyncio.Future] = None
+
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                self._log_lines += 1
+                try:
+                    entry = json.loads(line)
+                    key, op = entry['key'], entry['op']
+                except (ValueError, KeyError):
+                    logger.warning(f'Skipped broken line in {self.path}: {line!r}')
+                    continue
+                if op == 'add':
+                    self._pending[key] = entry['payload']
+                else:
+                    self._pending.pop(key, None)
+                    self._remember_done(key)
+        self._compact(self._snapshot())
+
+    def _remember_done(self, key: str):
+        self._done[key] = None
+        self._done.move_to_end(key)
+        if len(self._done) > self.max_done_keys:
+            self._done.popitem(last=False)
+
+    def _snapshot(self) -> List[str]:
+        return [json.dumps({'op': 'add', 'key': key, 'payload': payload}) + '\n'
+                for key, payload in self._pending.items()]
+
+    def _compact(self, lines: List[str]):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(''.join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._log_lines = len(lines)
+
+    def _write(self, lines: List[str]):
+        if self._file is None:
+            self._file = open(self.path, 'a', encoding='utf-8')
+        self._file.write(''.join(lines))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._log_lines += len(lines)
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        lines, self._buffer = self._buffer, []
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._write, lines)
+        # 日志几乎全是已完成的记录时压缩。快照在事件循环线程中生成，之后的变更仍在缓冲中，下次追加
+        if self._log_lines > self.compact_threshold and self._log_lines > 4 * len(self._pending):
+            await loop.run_in_executor(None, self._compact, self._snapshot())
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            # 取消不能打断执行器里正在进行的写入，close会等它完成
+            self._flushing = asyncio.ensure_future(self.flush())
+            try:
+                await asyncio.shield(self._flushing)
+            except OSError as e:
+                logger.error(f'Failed to write outbox {self.path}: {e}')
+
+    def start(self):
+        if self._flusher is None:
+            self._flusher = asyncio.ensure_future(self._flush_periodically())
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        if self._flushing is not None:
+            await asyncio.gather(self._flushing, return_exceptions=True)
+            self._flushing = None
+        await self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def add(self, tweet: Tweet) -> bool:
+        """
+        记录收到的推文，已在outbox中或最近已完成的推文返回False
+        """
+        key = str(tweet.id)
+        if key in self._pending or key in self._done:
+            return False
+        payload = tweet.to_payload()
+        self._pending[key] = payload
+        self._buffer.append(json.dumps({'op': 'add', 'key': key, 'payload': payload}) + '\n')
+        return True
+
+    def mark_done(self, tweet_id):
+        key = str(tweet_id)
+        if self._pending.pop(key, None) is None:
+            return
+        self._remember_done(key)
+        self._buffer.append(json.dumps({'op': 'done', 'key': key}) + '\n')
+
+    def pending(self) -> List[Tweet]:
+        return [Tweet.from_payload(payload) for payload in self._pending.values()]
@@ -0,0 +1,104 @@
+import time
+import asyncio
+from collections import deque
+from loguru import logger
+
+from .tweet import Tweet
+
+from typing import Callable, Coroutine, Deque, Dict, Hashable, List, Optional
+
+
+def author_key(tweet: Tweet) -> Hashable:
+    return tweet.author.username if tweet.author is not None else tweet.id
+
+
+class TweetQueue:
+    """
+    listener与handler之间的有界缓冲。读stream的协程只负责入队，由固定数量的worker调用handler，
+    同一个key（默认为作者）的推文按到达顺序串行处理，不同key之间并行
+
+    队列满时put会阻塞（背压），阻塞超过put_timeout秒则丢弃该推文（溢出）
+    """
+
+    def __init__(self, handler: Callable[[Tweet], Coroutine], maxsize: int = 100, workers: int = 4,
+                 put_timeout: Optional[float] = 10, key: Callable[[Tweet], Hashable] = author_key) -> None:
+        self.handler = handler
+        self.maxsize = maxsize
+        self.workers = workers
+        self.put_timeout = put_timeout
+        self.key = key
+
+        self._queue: 'asyncio.Queue[Tweet]' = asyncio.Queue()
+        self._slots = asyncio.Semaphore(maxsize)
+        # 正在被某个worker处理的key，以及排在它后面的同key推文
+        self._pending: Dict[Hashable, Deque[Tweet]] = {}
+        self._worker_tasks: List[asyncio.Task] = []
+
+        self.depth = 0
+        self.stats = {
+            'enqueued': 0, 'processed': 0, 'max_depth': 0,
+            'backpressure_events': 0, 'backpressure_seconds': 0.0, 'overflow': 0}
+
+    def start(self):
+        if not self._worker_tasks:
+            self._worker_tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+
+    async def put(self, tweet: Tweet) -> bool:
+        if self._slots.locked():
+            self.stats['backpressure_events'] += 1
+            logger.warning(f'Tweet queue is full ({self.maxsize}), stream reading is blocked')
+            start = time.monotonic()
+            try:
+                await asyncio.wait_for(self._slots.acquire(), self.put_timeout)
+            except asyncio.TimeoutError:
+                self.stats['overflow'] += 1
+                logger.error(f'Tweet queue overflowed, dropped tweet id {tweet.id}')
+                return False
+            finally:
+                self.stats['backpressure_seconds'] += time.monotonic() - start
+        else:
+            await self._slots.acquire()
+
+        self.depth += 1
+        self.stats['enqueued'] += 1
+        self.stats['max_depth'] = max(self.stats['max_depth'], self.depth)
+        self._queue.put_nowait(tweet)
+        return True
+
+    async def join(self):
+        while self.depth:
+            await asyncio.sleep(0.05)
+
+    async def _process(self, tweet: Tweet):
+        try:
+            await self.handler(tweet)
+        except Exception as e:
+            logger.error(f'Error {e} on handling tweet id {tweet.id}')
+        finally:
+            self.depth -= 1
+            self.stats['processed'] += 1
+            self._slots.release()
+
+    async def _worker(self):
+        while True:
+            tweet = await self._queue.get()
+            key = self.key(tweet)
+            pending = self._pending.get(key, None)
+            if pending is not None:
+                # 同key的推文正在被其他worker处理，交给它按序处理
+                pending.append(tweet)
+                continue
+
+            pending = self._pending[key] = deque([tweet])
+            try:
+                while pending:
+                    await self._process(pending[0])
+                    pending.popleft()
+            finally:
+                del self._pending[key]
@@ -0,0 +1,110 @@
+"""
+事件循环的采样分析器，用于找出阻塞事件循环的同步操作，如在事件循环里读写文件、解析大段JSON。
+开启后后台线程每隔interval秒取一次事件循环所在线程的调用栈，停止时把采到的栈以折叠格式
+（每行为"帧;帧;帧 次数"，flamegraph.pl和speedscope可以直接读取）写入文件，并在日志中输出占用最多的函数。
+停在selector里等待IO的样本记为空闲
+
+    kill -USR1 <pid>  # 开始，再发一次停止，超过max_seconds自动停止
+"""
+import os
+import sys
+import time
+import threading
+from collections import Counter
+from loguru import logger
+
+from typing import Optional
+
+
+class LoopProfiler:
+    def __init__(self, output_dir: str = 'profiles', interval: float = 0.005,
+                 max_seconds: float = 60, top: int = 15) -> None:
+        self.output_dir = output_dir
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.top = top
+
+        self._thread: Optional[threading.Thread] = None
+        self._target: Optional[int] = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, thread_id: Optional[int] = None):
+        """
+        Args:
+            thread_id (int, optional): 采样的线程，默认为调用者所在的线程（在事件循环的信号处理中调用即为事件循环线程）
+        """
+        if self.running:
+            return
+        self._target = threading.get_ident() if thread_id is None else thread_id
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, name='t2b-loop-profiler', daemon=True)
+        self._thread.start()
+        logger.info(f'Started event loop profiler, sampling every {self.interval * 1000:.0f}ms '
+                    f'for at most {self.max_seconds:.0f}s')
+
+    def stop(self):
+        """
+        停止采样，结果由采样线程写出
+        """
+        self._stop.set()
+
+    def toggle(self):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    @staticmethod
+    def _frame_name(frame) -> str:
+        code = frame.f_code
+        return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+    def _sample(self):
+        stacks: Counter = Counter()
+        samples = idle = 0
+        start = time.monotonic()
+        while not self._stop.wait(self.interval) and time.monotonic() - start < self.max_seconds:
+            frame = sys._current_frames().get(self._target, None)
+            if frame is None:
+                break
+            samples += 1
+            if os.path.basename(frame.f_code.co_filename) == 'selectors.py':
+                idle += 1
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._frame_name(frame))
+                frame = frame.f_back
+            stacks[';'.join(reversed(stack))] += 1
+        # 写文件也在采样线程里进行，不占用事件循环
+        try:
+            self._write(stacks, samples, idle, time.monotonic() - start)
+        except Exception as e:
+            logger.error(f'Failed to write event loop profile: {e!r}')
+
+    def _write(self, stacks: Counter, samples: int, idle: int, seconds: float):
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, time.strftime('loop-%Y%m%d-%H%M%S.folded', time.localtime()))
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+        busy = samples - idle
+        logger.info(f'Event loop profile: {samples} samples in {seconds:.1f}s, '
+                    f'busy {busy / max(samples, 1):.1%}, written to {path}')
+        if not busy:
+            return
+        # self为栈顶是该函数的样本，total为栈中包含该函数的样本
+        own: Counter = Counter()
+        total: Counter = Counter()
+        for stack, count in stacks.items():
+            frames = stack.split(';')
+            own[frames[-1]] += count
+            for name in set(frames):
+                total[name] += count
+        for name, count in own.most_common(self.top):
+            logger.info(f'  self {count / samples:6.1%}  total {total[name] / samples:6.1%}  {name}')
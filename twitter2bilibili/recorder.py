@@ -0,0 +1,86 @@
+"""
+filtered stream原始数据的录制与读取。录制文件为gzip压缩的JSON Lines，每行为{"time": 收到时的unix时间戳, "line": 原始数据}
+"""
+import os
+import glob
+import gzip
+import json
+import time
+import zlib
+from loguru import logger
+
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+
+class StreamRecorder:
+    """
+    按大小轮换录制文件，未压缩的数据超过max_bytes时换新文件，只保留最新的max_files个文件
+    """
+
+    def __init__(self, directory: str = 'stream_capture', max_bytes: int = 64 << 20,
+                 max_files: int = 20, flush_interval: float = 5) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.flush_interval = flush_interval
+
+        self._file = None
+        self._written = 0
+        self._last_flush = time.monotonic()
+        os.makedirs(directory, exist_ok=True)
+
+    def _open(self):
+        name = time.strftime('stream-%Y%m%d-%H%M%S', time.localtime())
+        path = os.path.join(self.directory, name + '.jsonl.gz')
+        suffix = 1
+        while os.path.exists(path):
+            path = os.path.join(self.directory, f'{name}-{suffix}.jsonl.gz')
+            suffix += 1
+        self._file = gzip.open(path, 'wt', encoding='utf-8')
+        self._written = 0
+        for old_path in capture_files(self.directory)[:-self.max_files]:
+            os.remove(old_path)
+
+    def record(self, line: bytes, receive_time: Optional[float] = None):
+        if self._file is None or self._written > self.max_bytes:
+            self.close()
+            self._open()
+        entry = json.dumps({'time': time.time() if receive_time is None else receive_time,
+                            'line': line.decode('utf-8', errors='replace').rstrip('\r\n')})
+        self._file.write(entry + '\n')
+        self._written += len(entry) + 1
+        # 定期刷新，进程崩溃时只丢失最后几秒
+        if time.monotonic() - self._last_flush > self.flush_interval:
+            self._file.flush()
+            self._last_flush = time.monotonic()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def capture_files(directory: str) -> List[str]:
+    return sorted(glob.glob(os.path.join(directory, 'stream-*.jsonl.gz')), key=os.path.getmtime)
+
+
+def read_capture(paths: Iterable[str]) -> Iterator[Tuple[float, bytes]]:
+    """
+    按顺序读出录制文件中的(收到时间, 原始数据)，目录会展开为其中的所有录制文件。
+    没有正常关闭的文件读到损坏处为止
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            yield from read_capture(capture_files(path))
+            continue
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        logger.warning(f'Skipped broken line in {path}: {line!r}')
+                        continue
+                    yield entry['time'], entry['line'].encode('utf-8')
+        except (EOFError, zlib.error, gzip.BadGzipFile) as e:
+            logger.warning(f'Capture file {path} is truncated: {e!r}')
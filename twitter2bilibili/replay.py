@@ -0,0 +1,108 @@
+"""
+重放录制的filtered stream（配置stream_capture_dir后录制）。录制的数据按原来的时间间隔或加速后
+经过与线上相同的解析和转发流程，B站发送器换成不发出请求的DryRunSender。
+图片下载和推特API查询照常进行，转发记录等状态写在临时目录，不影响线上运行的文件
+
+    python -m twitter2bilibili.replay stream_capture --speed 10
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import importlib
+import tempfile
+from types import SimpleNamespace
+from loguru import logger
+
+from .forwarder import T2BForwarder
+from .recorder import read_capture
+from .sender import DryRunSender
+
+from typing import Dict, List, Optional
+
+
+def make_replay_config(config_object, workdir: str, trace_path: Optional[str] = None) -> SimpleNamespace:
+    """
+    Args:
+        trace_path (str, optional): 重放时的trace文件，不沿用线上的trace_path
+    """
+    options = {key: value for key, value in vars(config_object).items() if not key.startswith('__')}
+    options.update(
+        forward_info_path=os.path.join(workdir, 'forward_info.jsonl'),
+        outbox_path=os.path.join(workdir, 'outbox.jsonl'),
+        learned_words_path=os.path.join(workdir, 'learned_words.json'),
+        media_cache_dir=os.path.join(workdir, 'media_cache'),
+        profile_dir=os.path.join(workdir, 'profiles'),
+        uploaded_images_path=None, backfill_state_path=None,
+        stream_capture_dir=None, config_watch_interval=None,
+        # 可能与线上运行的进程同时运行，不占用指标端口
+        metrics_port=None, trace_path=trace_path)
+    return SimpleNamespace(**options)
+
+
+async def replay(forwarder: T2BForwarder, paths: List[str], speed: float = 1,
+                 send_latency: float = 0) -> Dict:
+    """
+    Args:
+        speed (float): 重放速度倍数，0为不等待，尽快送入
+        send_latency (float): DryRunSender每次调用的模拟延迟（秒）
+    """
+    for account in forwarder.accounts.values():
+        account.sender = account.scheduler.sender = DryRunSender(send_latency, sanitizer=forwarder.sanitizer)
+
+    await forwarder.start()
+    lines = 0
+    start = time.monotonic()
+    try:
+        first_time = None
+        for receive_time, line in read_capture(paths):
+            if speed > 0:
+                if first_time is None:
+                    first_time = receive_time
+                delay = (receive_time - first_time) / speed - (time.monotonic() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await forwarder.listener.process_line(line, forwarder.receive)
+            lines += 1
+        await forwarder.queue.join()
+    finally:
+        elapsed = time.monotonic() - start
+        await forwarder.stop()
+
+    return {
+        'lines': lines,
+        'tweets': forwarder.queue.stats['enqueued'],
+        'elapsed_seconds': round(elapsed, 3),
+        'queue': forwarder.queue.stats,
+        'dry_run_calls': {name: account.sender.calls for name, account in forwarder.accounts.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', help='录制文件或录制目录')
+    parser.add_argument('--config', default='config', help='配置模块名')
+    parser.add_argument('--speed', type=float, default=1, help='重放速度倍数，0为尽快送入')
+    parser.add_argument('--send-latency', type=float, default=0, help='模拟的B站接口延迟（秒）')
+    parser.add_argument('--trace-path', default=None, help='把重放的推文的trace写入此文件（JSON Lines）')
+    parser.add_argument('--verbose', action='store_true', help='输出转发日志')
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level='DEBUG' if args.verbose else 'WARNING')
+
+    config_object = importlib.import_module(args.config)
+    with tempfile.TemporaryDirectory() as workdir:
+        forwarder = T2BForwarder(make_replay_config(config_object, workdir, args.trace_path))
+        try:
+            report = asyncio.get_event_loop().run_until_complete(
+                replay(forwarder, args.paths, args.speed, args.send_latency))
+        finally:
+            forwarder.close()
+    for key, value in report.items():
+        print(f'{key}: {value}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+from loguru import logger
+
+from typing import Dict, List, Optional, Set, TYPE_CHECKING
+if TYPE_CHECKING:
+    from .listener import TwitterListener
+
+
+RULE_SEPARATOR = ' OR '
+
+
+class RuleLimitExceeded(Exception):
+    pass
+
+
+def make_rule_value(usernames: List[str]) -> str:
+    return RULE_SEPARATOR.join('from:' + username for username in usernames)
+
+
+def parse_rule_value(value: str) -> Optional[List[str]]:
+    """
+    解析由make_rule_value生成的规则，不是此格式的规则返回None
+    """
+    usernames = []
+    for clause in value.split(RULE_SEPARATOR):
+        if not clause.startswith('from:') or ' ' in clause:
+            return None
+        usernames.append(clause[len('from:'):])
+    return usernames
+
+
+def pack_usernames(usernames: List[str], max_length: int, max_count: Optional[int] = None) -> List[List[str]]:
+    """
+    将用户装箱成尽量少的规则，每条规则不超过max_length个字符（first-fit decreasing）
+    """
+    bins: List[List[str]] = []
+    lengths: List[int] = []
+    for username in sorted(usernames, key=len, reverse=True):
+        clause_length = len('from:' + username)
+        if clause_length > max_length:
+            raise RuleLimitExceeded(f'username {username} is too long for a rule')
+        for i, length in enumerate(lengths):
+            if length + len(RULE_SEPARATOR) + clause_length <= max_length:
+                bins[i].append(username)
+                lengths[i] += len(RULE_SEPARATOR) + clause_length
+                break
+        else:
+            bins.append([username])
+            lengths.append(clause_length)
+    if max_count is not None and len(bins) > max_count:
+        raise RuleLimitExceeded(f'{len(usernames)} users need {len(bins)} rules, more than the limit {max_count}')
+    return bins
+
+
+class RuleManager:
+    """
+    维护filtered stream的规则，使其恰好覆盖订阅的用户。
+    与现有规则比较后只增删变化的部分：仍然有效的规则原样保留，新用户装箱进新规则，
+    新规则数超过上限时才整体重新装箱。规则数允许时先添加后删除，过程中不会出现没有规则生效的时间窗口
+    """
+
+    def __init__(self, listener: 'TwitterListener', tag: str = 't2b',
+                 max_length: int = 512, max_count: int = 5) -> None:
+        self.listener = listener
+        self.tag = tag
+        self.max_length = max_length
+        self.max_count = max_count
+
+    def plan(self, usernames: Set[str], rules: List[Dict]):
+        """
+        Returns:
+            (要添加的规则, 要删除的规则id)
+        """
+        kept: List[Dict] = []
+        covered: Set[str] = set()
+        delete_ids: List[str] = []
+        for rule in rules:
+            rule_users = parse_rule_value(rule['value'])
+            if (rule_users is None or not set(rule_users) <= usernames
+                    or covered & set(rule_users) or len(rule['value']) > self.max_length):
+                delete_ids.append(rule['id'])
+            else:
+                kept.append(rule)
+                covered.update(rule_users)
+
+        missing = sorted(usernames - covered)
+        new_bins = pack_usernames(missing, self.max_length) if missing else []
+        if len(kept) + len(new_bins) > self.max_count:
+            # 增量装箱放不下，整体重新装箱
+            new_bins = pack_usernames(sorted(usernames), self.max_length, self.max_count)
+            delete_ids = [rule['id'] for rule in rules]
+
+        add_rules = [{'value': make_rule_value(sorted(users)), 'tag': self.tag} for users in new_bins]
+        return add_rules, delete_ids
+
+    async def sync(self, usernames: Set[str]):
+        rules = await self.listener.get_rules()
+        add_rules, delete_ids = self.plan(set(usernames), rules)
+        if len(rules) + len(add_rules) > self.max_count:
+            # 先添加会超过规则数上限，只能先删除
+            await self.listener.delete_rules(delete_ids)
+            await self.listener.add_rules(add_rules)
+        else:
+            await self.listener.add_rules(add_rules)
+            await self.listener.delete_rules(delete_ids)
+        logger.info(f'Synced stream rules: {len(add_rules)} added, {len(delete_ids)} deleted, '
+                    f'{len(self.listener.rules)} active')
+
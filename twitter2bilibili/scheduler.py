@@ -0,0 +1,164 @@
+import time
+import random
+import asyncio
+import itertools
+from loguru import logger
+
+from bilibili_api.exceptions import ResponseCodeException
+
+from .sender import BiliSender
+from .tracing import tracer
+
+from typing import Callable, Coroutine, Dict, Optional, Set
+
+
+# -509: 请求过于频繁，-412: 请求被拦截，12015: 评论需要验证码
+RATE_LIMIT_CODES = {-509, -412, 12015}
+
+
+class TokenBucket:
+    """
+    发送速率随B站的返回调整的令牌桶：被限流时速率减半，成功时线性回升
+    """
+
+    def __init__(self, rate: float, burst: int = 1, min_rate: Optional[float] = None,
+                 max_rate: Optional[float] = None) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = rate / 16 if min_rate is None else min_rate
+        self.max_rate = rate * 2 if max_rate is None else max_rate
+        self._step = rate / 10
+
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def on_success(self):
+        self.rate = min(self.max_rate, self.rate + self._step)
+
+    def on_throttled(self):
+        self.rate = max(self.min_rate, self.rate / 2)
+        self._tokens = 0
+
+
+class _Job:
+    def __init__(self, action: str, func: Callable[..., Coroutine], kwargs: Dict) -> None:
+        self.action = action
+        self.func = func
+        self.kwargs = kwargs
+        self.attempt = 0
+        self.submit_time = time.monotonic()
+        # 提交时的span，发送在调度器的任务里进行，不会自动继承
+        self.span = tracer.current()
+        self.future: asyncio.Future = asyncio.get_event_loop().create_future()
+
+
+class SendScheduler:
+    """
+    BiliSender前的发送调度：所有请求按优先级（动态 > 转发 > 评论）排队，经令牌桶限速后发出。
+    被限流的请求按抖动的指数退避重新排队；其他错误直接抛给调用方，
+    网络错误不重试以免重复发出动态
+    """
+    PRIORITY = {'send': 0, 'repost': 1, 'comment': 2}
+
+    def __init__(self, sender: BiliSender, rate: float = 0.5, burst: int = 3,
+                 max_retries: int = 5, backoff: float = 5,
+                 rate_limit_codes: Set[int] = RATE_LIMIT_CODES) -> None:
+        self.sender = sender
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.rate_limit_codes = rate_limit_codes
+
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._counter = itertools.count()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._running: Set[asyncio.Task] = set()
+
+        self.stats: Dict[str, Dict] = {action: {
+            'count': 0, 'queue_seconds_total': 0.0, 'queue_seconds_max': 0.0,
+            'throttled': 0, 'failed': 0} for action in self.PRIORITY}
+
+    def _put(self, job: _Job):
+        self._queue.put_nowait((self.PRIORITY[job.action], next(self._counter), job))
+
+    async def _submit(self, action: str, func: Callable[..., Coroutine], **kwargs):
+        if self._dispatcher is None:
+            self._queue = asyncio.PriorityQueue()
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+        job = _Job(action, func, kwargs)
+        self._put(job)
+        return await job.future
+
+    async def _dispatch(self):
+        while True:
+            _, _, job = await self._queue.get()
+            await self.bucket.acquire()
+            task = asyncio.ensure_future(self._execute(job))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _execute(self, job: _Job):
+        stats = self.stats[job.action]
+        if job.attempt == 0:
+            latency = time.monotonic() - job.submit_time
+            stats['count'] += 1
+            stats['queue_seconds_total'] += latency
+            stats['queue_seconds_max'] = max(stats['queue_seconds_max'], latency)
+            logger.debug(f'Bilibili {job.action} waited {latency:.2f}s in send queue')
+
+        try:
+            with tracer.activate(job.span), tracer.span(
+                    f'send_queue.{job.action}', attempt=job.attempt,
+                    queue_seconds=round(time.monotonic() - job.submit_time, 6)):
+                result = await job.func(**job.kwargs)
+        except ResponseCodeException as e:
+            if e.code in self.rate_limit_codes and job.attempt < self.max_retries:
+                stats['throttled'] += 1
+                self.bucket.on_throttled()
+                delay = self.backoff * 2 ** job.attempt * (0.5 + random.random())
+                job.attempt += 1
+                logger.warning(f'Bilibili {job.action} throttled with code {e.code}, '
+                               f'retry {job.attempt} in {delay:.1f}s, rate now {self.bucket.rate:.3f}/s')
+                await asyncio.sleep(delay)
+                self._put(job)
+            else:
+                stats['failed'] += 1
+                job.future.set_exception(e)
+        except Exception as e:
+            stats['failed'] += 1
+            job.future.set_exception(e)
+        else:
+            self.bucket.on_success()
+            job.future.set_result(result)
+
+    async def stop(self):
+        tasks = list(self._running)
+        if self._dispatcher is not None:
+            tasks.append(self._dispatcher)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._dispatcher = None
+
+    async def send(self, text: str, image_streams=None):
+        return await self._submit('send', self.sender.send, text=text, image_streams=image_streams)
+
+    async def send_comment(self, text: str, dynamic_id: int, target=None):
+        return await self._submit('comment', self.sender.send_comment,
+                                  text=text, dynamic_id=dynamic_id, target=target)
+
+    async def repost_dynamic(self, text: str, dynamic_id: int):
+        return await self._submit('repost', self.sender.repost_dynamic, text=text, dynamic_id=dynamic_id)
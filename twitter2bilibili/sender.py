@@ -1,65 +1,274 @@
-from bilibili_api import Credential
+from bilibili_api import Credential, dynamic as bili_dynamic
 from bilibili_api.dynamic import send_dynamic, Dynamic
 from bilibili_api.comment import send_comment, ResourceType
 from bilibili_api.exceptions import ResponseCodeException
+from bilibili_api.exceptions.DynamicExceedImagesException import DynamicExceedImagesException
+from bilibili_api.utils.network_httpx import request as bili_request
 
-import emoji
+from .forward_store import TTLStore
+from .metrics import metrics
+from .text_filter import TextSanitizer
+from .tracing import tracer
+
+import json
+import time
+import asyncio
+import hashlib
+import itertools
+from collections import OrderedDict
 from functools import wraps
 
-from typing import List, Optional
-from io import BufferedIOBase
+from typing import Dict, List, Optional, Tuple
 
 
-def _handle_illegal_word(func):
-    ILLEGAL_EMOJEE = {
-        '🐴': '马', '🐻': '熊', '🔥': '火', '🗼': '塔',
-        '🐧': '企鹅', '💡': '灯泡', '🐎': '马', '🐠': '热带鱼',
-        '🏀': '篮球', '🐶':'狗', '⚽': '足球', '🐢': '乌龟',
-        '💉': '注射器', '🐮':'牛', '👋': '挥手',
-        '0️⃣':'0','1️⃣':'1','2️⃣':'2','3️⃣':'3','4️⃣':'4',
-        '5️⃣':'5','6️⃣':'6','7️⃣':'7','8️⃣':'8','9️⃣':'9'
-    }
+ILLEGAL_WORD_CODES = {2200108, 4126021}
+
+# 未知emoji超过这个数时不再逐个尝试，避免短时间内发出太多请求
+MAX_LEARN_CANDIDATES = 5
+
 
+def _handle_illegal_word(func):
+    @wraps(func)
     async def wrapped_func(self, text: str, *args, **kwargs):
-        for emoji_chr, emoji_text in ILLEGAL_EMOJEE.items():
-            if emoji_chr in text:
-                text = text.replace(emoji_chr, f'[emoji {emoji_text}]')
+        text = self.sanitizer.sanitize(text)
         try:
             return await func(self, text=text, *args, **kwargs)
         except ResponseCodeException as e:
-            if e.code in {2200108, 4126021}:
-                text = emoji.demojize(text, delimiters=('[emoji ', ']'))
-                return await func(self, text=text, *args, **kwargs)
-            else:
+            candidates = self.sanitizer.candidates(text) if e.code in ILLEGAL_WORD_CODES else []
+            if not candidates:
                 raise e
+            # 每次只替换一个emoji，被接受时就确定是它导致的拒绝，同时发出的其他emoji都没有问题。
+            # 都不行时可能不止一个，全部替换后再试一次，但无法确定是哪些，不学习
+            attempts = [[word] for word in candidates] if len(candidates) <= MAX_LEARN_CANDIDATES else []
+            if len(candidates) > 1:
+                attempts.append(candidates)
+            for words in attempts:
+                try:
+                    result = await func(self, text=self.sanitizer.replace(text, words), *args, **kwargs)
+                except ResponseCodeException as retry_error:
+                    if retry_error.code not in ILLEGAL_WORD_CODES:
+                        raise
+                    continue
+                if len(words) == 1:
+                    self.sanitizer.learn(words[0])
+                return result
+            raise e
     return wrapped_func
 
 
+def _measure(method: str):
+    def decorator(func):
+        @wraps(func)
+        async def wrapped_func(*args, **kwargs):
+            try:
+                with metrics.timer('t2b_bilibili_request_seconds', method=method), tracer.span(f'bilibili.{method}'):
+                    return await func(*args, **kwargs)
+            except ResponseCodeException as e:
+                metrics.inc('t2b_bilibili_errors_total', method=method, code=e.code)
+                raise
+        return wrapped_func
+    return decorator
+
+
 class BiliSender:
-    def __init__(self, sessdata, bili_jct, dedeuserid) -> None:
+    COMMENT_TYPE_MAP = {     # 1是转发动态，4为原创文字动态
+        1: ResourceType.DYNAMIC, 2: ResourceType.DYNAMIC_DRAW,
+        4: ResourceType.DYNAMIC, 8: ResourceType.VIDEO,
+        64: ResourceType.ARTICLE, 256: ResourceType.AUDIO}
+
+    def __init__(self, sessdata, bili_jct, dedeuserid, comment_target_ttl: float = 3600,
+                 comment_target_cache_size: int = 1000, sanitizer: Optional[TextSanitizer] = None,
+                 image_cache: Optional[TTLStore] = None) -> None:
+        """
+        Args:
+            image_cache (TTLStore, optional): 图片内容的sha256 -> 上传后B站返回的图片信息，
+                为None时每次都上传
+        """
         self.credential = Credential(
             sessdata=sessdata, bili_jct=bili_jct, dedeuserid=dedeuserid)
+        self.sanitizer = sanitizer if sanitizer is not None else TextSanitizer()
 
-    @_handle_illegal_word
-    async def send(self, text: str, image_streams: Optional[List[BufferedIOBase]] = None):
-        return await send_dynamic(text=text, image_streams=image_streams, credential=self.credential)
+        self.image_cache = image_cache
+        self._uploads: Dict[str, asyncio.Future] = {}
+        self.upload_stats = {'uploaded': 0, 'cached': 0, 'bytes_uploaded': 0, 'bytes_saved': 0}
 
-    @_handle_illegal_word
-    async def send_comment(self, text: str, dynamic_id: int):
-        type_map = {     # 1是转发动态，4为原创文字动态
-            1:ResourceType.DYNAMIC, 2:ResourceType.DYNAMIC_DRAW,
-            4:ResourceType.DYNAMIC, 8:ResourceType.VIDEO,
-            64:ResourceType.ARTICLE, 256:ResourceType.AUDIO}
+        # dynamic_id -> (过期时间, (评论区类型, oid))
+        self.comment_target_ttl = comment_target_ttl
+        self.comment_target_cache_size = comment_target_cache_size
+        self._comment_targets: 'OrderedDict[int, Tuple[float, Tuple[ResourceType, int]]]' = OrderedDict()
+        self._comment_target_lookups: Dict[int, asyncio.Future] = {}
+
+    @staticmethod
+    def comment_target_of_sent(response: Dict, with_images: bool) -> Optional[Tuple[ResourceType, int]]:
+        """
+        由send返回的数据得到该动态评论区的类型和oid，无法确定时返回None
+        """
+        if not with_images:
+            return ResourceType.DYNAMIC, int(response['dynamic_id'])
+        elif 'doc_id' in response:
+            return ResourceType.DYNAMIC_DRAW, int(response['doc_id'])
+        return None
+
+    def cache_comment_target(self, dynamic_id: int, target: Tuple[ResourceType, int]):
+        self._comment_targets.pop(dynamic_id, None)
+        self._comment_targets[dynamic_id] = (time.monotonic() + self.comment_target_ttl, target)
+        while len(self._comment_targets) > self.comment_target_cache_size:
+            self._comment_targets.popitem(last=False)
 
+    @_measure('get_info')
+    async def _lookup_comment_target(self, dynamic_id: int) -> Tuple[ResourceType, int]:
         dynamic = Dynamic(dynamic_id=dynamic_id, credential=self.credential)
         info = await dynamic.get_info()
-        type_ = type_map[info['desc']['type']]
+        type_ = self.COMMENT_TYPE_MAP[info['desc']['type']]
         oid = info['desc']['rid']
         if type_ == ResourceType.DYNAMIC:
             oid = dynamic_id
+        self.cache_comment_target(dynamic_id, (type_, oid))
+        return type_, oid
+
+    async def get_comment_target(self, dynamic_id: int) -> Tuple[ResourceType, int]:
+        cached = self._comment_targets.get(dynamic_id, None)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+
+        # 同一动态的并发查询合并为一次请求
+        future = self._comment_target_lookups.get(dynamic_id, None)
+        if future is None:
+            future = asyncio.ensure_future(self._lookup_comment_target(dynamic_id))
+            self._comment_target_lookups[dynamic_id] = future
+            future.add_done_callback(lambda _: self._comment_target_lookups.pop(dynamic_id, None))
+        return await asyncio.shield(future)
+
+    @_measure('upload')
+    async def _upload_image(self, key: str, image: bytes) -> Dict:
+        tracer.annotate(bytes=len(image))
+        info = await bili_dynamic.upload_image(image, self.credential)
+        info = {field: info[field] for field in ('image_url', 'image_width', 'image_height')}
+        self.upload_stats['uploaded'] += 1
+        self.upload_stats['bytes_uploaded'] += len(image)
+        if self.image_cache is not None:
+            self.image_cache.put(key, info)
+        return info
+
+    async def upload_image(self, image: bytes) -> Dict:
+        """
+        上传图片，内容相同的图片只上传一次
+
+        Returns:
+            包含image_url、image_width、image_height的字典
+        """
+        # 按账号区分，图片地址不在账号之间共用
+        key = f'{self.credential.dedeuserid}:{hashlib.sha256(image).hexdigest()}'
+        if self.image_cache is not None:
+            # 刷新时间，常用的图片（如gap_img）不会过期
+            cached = self.image_cache.touch(key)
+            if cached is not None:
+                self.upload_stats['cached'] += 1
+                self.upload_stats['bytes_saved'] += len(image)
+                metrics.inc('t2b_bilibili_upload_cache_hits_total')
+                tracer.add('images_cached', 1)
+                tracer.add('bytes_saved', len(image))
+                return cached
+
+        # 并发上传同一张图片时只上传一次
+        future = self._uploads.get(key, None)
+        if future is None:
+            future = asyncio.ensure_future(self._upload_image(key, image))
+            self._uploads[key] = future
+            future.add_done_callback(lambda _: self._uploads.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def _send_draw(self, text: str, images: List[bytes]) -> Dict:
+        """
+        与bilibili_api的send_dynamic发送图片动态相同，但图片经过upload_image去重
+        """
+        new_text, at_uids, ctrl = await bili_dynamic._parse_at(text)
+        images_info = await asyncio.gather(*[self.upload_image(image) for image in images])
+        pictures = [{'img_src': info['image_url'], 'img_width': info['image_width'],
+                     'img_height': info['image_height']} for info in images_info]
+        data = {
+            'biz': 3, 'category': 3, 'type': 0,
+            'pictures': json.dumps(pictures),
+            'title': '', 'tags': '',
+            'description': new_text, 'content': new_text,
+            'from': 'create.dynamic.web',
+            'up_choose_comment': 0,
+            'extension': json.dumps({'emoji_type': 1, 'from': {'emoji_type': 1}, 'flag_cfg': {}}),
+            'at_uids': at_uids, 'at_control': ctrl,
+            'setting': json.dumps({'copy_forbidden': 0, 'cachedTime': 0}),
+        }
+        api = bili_dynamic.API['send']['instant_draw']
+        return await bili_request('POST', api['url'], data=data, credential=self.credential)
+
+    @_measure('send')
+    @_handle_illegal_word
+    async def send(self, text: str, image_streams: Optional[List[bytes]] = None):
+        if image_streams:
+            tracer.annotate(images=len(image_streams), bytes=sum(map(len, image_streams)))
+            if len(image_streams) > 9:
+                raise DynamicExceedImagesException()
+            response = await self._send_draw(text, image_streams)
+        else:
+            response = await send_dynamic(text=text, credential=self.credential)
+        target = self.comment_target_of_sent(response, bool(image_streams))
+        if target is not None:
+            self.cache_comment_target(int(response['dynamic_id']), target)
+        return response
+
+    @_measure('comment')
+    @_handle_illegal_word
+    async def send_comment(self, text: str, dynamic_id: int,
+                           target: Optional[Tuple[ResourceType, int]] = None):
+        """
+        Args:
+            target (Tuple[ResourceType, int], optional): 已知的评论区类型和oid，为None时查询动态信息得到
+        """
+        if target is None:
+            target = await self.get_comment_target(dynamic_id)
+        type_, oid = target
         return await send_comment(text=text, oid=oid, type_=type_, credential=self.credential)
 
+    @_measure('repost')
     @_handle_illegal_word
     async def repost_dynamic(self, text: str, dynamic_id: int):
         dynamic = Dynamic(dynamic_id=dynamic_id, credential=self.credential)
         return await dynamic.repost(text)
+
+
+class DryRunSender(BiliSender):
+    """
+    不发出任何请求的BiliSender，返回伪造的动态id，用于重放录制的stream
+    """
+
+    def __init__(self, latency: float = 0, sanitizer: Optional[TextSanitizer] = None) -> None:
+        super().__init__(sessdata='dry-run', bili_jct='dry-run', dedeuserid='dry-run', sanitizer=sanitizer)
+        self.latency = latency
+        self.calls = {'send': 0, 'comment': 0, 'repost': 0}
+        self._ids = itertools.count(1)
+
+    async def send(self, text: str, image_streams: Optional[List[bytes]] = None):
+        self.sanitizer.sanitize(text)
+        await asyncio.sleep(self.latency)
+        self.calls['send'] += 1
+        if image_streams:
+            self.upload_stats['uploaded'] += len(image_streams)
+            self.upload_stats['bytes_uploaded'] += sum(map(len, image_streams))
+        dynamic_id = next(self._ids)
+        response = {'dynamic_id': dynamic_id, 'dynamic_id_str': str(dynamic_id)}
+        if image_streams:
+            response['doc_id'] = dynamic_id
+        self.cache_comment_target(dynamic_id, self.comment_target_of_sent(response, bool(image_streams)))
+        return response
+
+    async def send_comment(self, text: str, dynamic_id: int,
+                           target: Optional[Tuple[ResourceType, int]] = None):
+        self.sanitizer.sanitize(text)
+        await asyncio.sleep(self.latency)
+        self.calls['comment'] += 1
+        return {'rpid': next(self._ids)}
+
+    async def repost_dynamic(self, text: str, dynamic_id: int):
+        self.sanitizer.sanitize(text)
+        await asyncio.sleep(self.latency)
+        self.calls['repost'] += 1
+        return {}
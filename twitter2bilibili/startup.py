@@ -0,0 +1,93 @@
+"""
+启动加速与启动耗时统计。连上stream之前只导入和创建监听推文需要的部分，
+B站相关的模块（导入bilibili_api要几百毫秒）和组件在第一次用到时才导入、创建，
+或者在连上stream后提前在后台准备好
+"""
+import sys
+import time
+import importlib.util
+from contextlib import contextmanager
+from types import ModuleType
+from loguru import logger
+
+from typing import Dict, List, Optional, Tuple
+
+
+# 以导入本包的时刻为启动时刻
+STARTED = time.perf_counter()
+
+# 经import_module导入的模块 -> 导入耗时（秒），包含其依赖的导入
+import_times: Dict[str, float] = {}
+
+
+def import_module(name: str, package: Optional[str] = None) -> ModuleType:
+    name = importlib.util.resolve_name(name, package)
+    module = sys.modules.get(name, None)
+    if module is None:
+        start = time.perf_counter()
+        module = importlib.import_module(name)
+        import_times[name] = time.perf_counter() - start
+    return module
+
+
+class LazyModule:
+    """
+    第一次访问属性时才导入的模块，用法与模块相同：
+
+        bili_exceptions = LazyModule('bilibili_api.exceptions')
+        except bili_exceptions.ResponseCodeException: ...
+    """
+
+    def __init__(self, name: str, package: Optional[str] = None) -> None:
+        self._name = importlib.util.resolve_name(name, package)
+        self._module: Optional[ModuleType] = None
+
+    @property
+    def loaded(self) -> bool:
+        return self._module is not None or self._name in sys.modules
+
+    def load(self) -> ModuleType:
+        if self._module is None:
+            self._module = import_module(self._name)
+        return self._module
+
+    def __getattr__(self, item: str):
+        return getattr(self.load(), item)
+
+    def __repr__(self) -> str:
+        return f'LazyModule({self._name!r})'
+
+
+class StartupProfile:
+    """
+    记录启动各阶段的耗时，phase为一段时间，mark为从启动到某个时刻（如连上stream）的时间
+    """
+
+    def __init__(self) -> None:
+        self.phases: List[Tuple[str, float]] = []
+        self.marks: Dict[str, float] = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start))
+
+    def mark(self, name: str):
+        if name not in self.marks:
+            self.marks[name] = time.perf_counter() - STARTED
+
+    def report(self) -> Dict:
+        return {
+            'imports': {name: round(seconds, 3) for name, seconds in import_times.items()},
+            'phases': {name: round(seconds, 3) for name, seconds in self.phases},
+            'marks': {name: round(seconds, 3) for name, seconds in self.marks.items()},
+        }
+
+    def log(self):
+        report = self.report()
+        for key in ('imports', 'phases', 'marks'):
+            items = ', '.join(f'{name} {seconds:.3f}s' for name, seconds in report[key].items())
+            logger.info(f'Startup {key}: {items or "none"}')
@@ -0,0 +1,107 @@
+import time
+import random
+import asyncio
+import aiohttp
+from loguru import logger
+
+from .twitter_api import TwitterAPIException, ClientResponse
+
+from typing import AsyncIterator, Dict, Optional
+
+
+class StreamStalled(Exception):
+    def __init__(self, silent_seconds: float) -> None:
+        super().__init__(f'no data or keep-alive for {silent_seconds:.1f}s')
+        self.silent_seconds = silent_seconds
+
+
+class Backoff:
+    """
+    退避策略，linear为True时每次增加initial，否则每次乘以factor。实际等待时间在[delay/2, delay]之间随机
+    """
+
+    def __init__(self, initial: float, maximum: float, factor: float = 2, linear: bool = False) -> None:
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.linear = linear
+        self._delay = 0.0
+
+    def next_delay(self) -> float:
+        if self._delay == 0:
+            self._delay = self.initial
+        elif self.linear:
+            self._delay = min(self.maximum, self._delay + self.initial)
+        else:
+            self._delay = min(self.maximum, self._delay * self.factor)
+        return self._delay * (0.5 + random.random() / 2)
+
+    def reset(self):
+        self._delay = 0.0
+
+
+class ConnectionSupervisor:
+    """
+    监视filtered stream连接：按keep-alive的节奏检测连接是否卡死，
+    连接失败时按失败类型（网络错误、429、5xx、其他HTTP错误）分别退避，
+    连接恢复正常收到数据后重置所有退避
+    """
+
+    def __init__(self, stall_timeout: float = 60, policies: Optional[Dict[str, Backoff]] = None) -> None:
+        self.stall_timeout = stall_timeout
+        # 参考推特的建议：网络错误线性退避，HTTP错误指数退避，429从一分钟开始指数退避
+        self.policies = policies if policies is not None else {
+            'network': Backoff(0.25, 16, linear=True),
+            'server': Backoff(5, 320),
+            'http': Backoff(5, 320),
+            'rate_limit': Backoff(60, 960),
+        }
+        self.keep_alive_interval: Optional[float] = None
+        self.stall_count = 0
+        self._healthy = False
+
+    @staticmethod
+    def classify(error: BaseException) -> str:
+        if isinstance(error, TwitterAPIException):
+            if error.code == 429:
+                return 'rate_limit'
+            elif error.code >= 500:
+                return 'server'
+            return 'http'
+        return 'network'
+
+    def on_failure(self, error: BaseException) -> float:
+        kind = self.classify(error)
+        delay = self.policies[kind].next_delay()
+        logger.info(f'Stream failure classified as {kind}, reconnect in {delay:.1f}s')
+        return delay
+
+    def on_connected(self):
+        self._healthy = False
+
+    def _on_line(self):
+        if not self._healthy:
+            # 收到第一行才算连接真正恢复
+            self._healthy = True
+            for policy in self.policies.values():
+                policy.reset()
+
+    async def read_lines(self, response: ClientResponse) -> AsyncIterator[bytes]:
+        last = time.monotonic()
+        while True:
+            try:
+                line = await asyncio.wait_for(response.content.readline(), self.stall_timeout)
+            except asyncio.TimeoutError:
+                self.stall_count += 1
+                raise StreamStalled(time.monotonic() - last)
+            if not line:
+                raise aiohttp.ClientPayloadError('stream closed by server')
+
+            now = time.monotonic()
+            if line == b'\r\n':
+                interval = now - last
+                self.keep_alive_interval = interval if self.keep_alive_interval is None \
+                    else 0.8 * self.keep_alive_interval + 0.2 * interval
+            last = now
+            self._on_line()
+            yield line
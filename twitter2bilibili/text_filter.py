@@ -0,0 +1,98 @@
+import os
+import re
+import json
+from loguru import logger
+
+from .startup import LazyModule
+
+from typing import Dict, List, Optional
+
+
+# 只在学习违禁词时用到
+emoji = LazyModule('emoji')
+
+# B站会拒绝的emoji，值为替换后显示的文字
+ILLEGAL_EMOJI = {
+    '🐴': '马', '🐻': '熊', '🔥': '火', '🗼': '塔',
+    '🐧': '企鹅', '💡': '灯泡', '🐎': '马', '🐠': '热带鱼',
+    '🏀': '篮球', '🐶': '狗', '⚽': '足球', '🐢': '乌龟',
+    '💉': '注射器', '🐮': '牛', '👋': '挥手',
+    '0️⃣': '0', '1️⃣': '1', '2️⃣': '2', '3️⃣': '3', '4️⃣': '4',
+    '5️⃣': '5', '6️⃣': '6', '7️⃣': '7', '8️⃣': '8', '9️⃣': '9'
+}
+
+
+def _emoji_replacement(name: str) -> str:
+    return f'[emoji {name}]'
+
+
+class TextSanitizer:
+    """
+    发送前替换B站会拒绝的词。所有词编译成一个正则，一次扫描完成替换。
+
+    词表由内置emoji表、可选的词表文件（JSON，词 -> 替换文本）和学习到的词组成。
+    B站因违禁词拒绝发送时，发送器每次只替换文本中的一个未知emoji重试，被接受时说明就是它导致的拒绝，
+    它会被记入学习表并持久化，之后的文本在首次发送前就会被替换。其余emoji随文本一起发出，不会被学到
+    """
+
+    def __init__(self, word_list_path: Optional[str] = None,
+                 learned_path: Optional[str] = 'learned_words.json') -> None:
+        self.learned_path = learned_path
+        self.words: Dict[str, str] = {
+            word: _emoji_replacement(name) for word, name in ILLEGAL_EMOJI.items()}
+        if word_list_path is not None:
+            with open(word_list_path, 'r', encoding='utf-8') as f:
+                self.words.update(json.load(f))
+
+        self.learned: Dict[str, str] = {}
+        if learned_path is not None and os.path.exists(learned_path):
+            with open(learned_path, 'r', encoding='utf-8') as f:
+                self.learned = json.load(f)
+
+        self._compile()
+
+    def _compile(self):
+        self._table = {**self.words, **self.learned}
+        # 长词优先，避免keycap之类的多码位emoji只被替换一部分
+        words = sorted(self._table, key=len, reverse=True)
+        self._pattern = re.compile('|'.join(map(re.escape, words))) if words else None
+
+    def sanitize(self, text: str) -> str:
+        if self._pattern is None:
+            return text
+        return self._pattern.sub(lambda m: self._table[m.group()], text)
+
+    def candidates(self, text: str) -> List[str]:
+        """
+        被B站拒绝的文本中尚未替换的emoji，可能是拒绝的原因
+        """
+        return sorted(set(emoji_chr for emoji_chr in emoji.get_emoji_regexp().findall(text)
+                          if emoji_chr not in self._table))
+
+    @staticmethod
+    def replace(text: str, words: List[str]) -> str:
+        """
+        只替换words，用于找出导致拒绝的词
+        """
+        for word in sorted(words, key=len, reverse=True):
+            text = text.replace(word, emoji.demojize(word, delimiters=('[emoji ', ']')))
+        return text
+
+    def learn(self, word: str):
+        """
+        记录确定会被B站拒绝的词并持久化
+        """
+        if word in self._table:
+            return
+        self.learned[word] = emoji.demojize(word, delimiters=('[emoji ', ']'))
+        logger.info(f'Learned rejected word: {word}')
+        self._compile()
+        self._save()
+
+    def _save(self):
+        if self.learned_path is None:
+            return
+        tmp_path = self.learned_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.learned, f, ensure_ascii=False)
+        os.replace(tmp_path, self.learned_path)
@@ -0,0 +1,176 @@
+"""
+单条推文的追踪。每条推文从stream收到时开始一个trace，处理中的各步骤（判断转发方式、获取媒体信息、
+下载和处理图片、发送队列、B站接口调用）记为其中的span，结束时以JSON Lines写入文件，每行一个span：
+
+    {"trace_id": "...", "span_id": "...", "parent_id": "...", "name": "bilibili.upload",
+     "start": 1690000000.123, "duration": 0.456, "attributes": {"bytes": 123456}, "error": null}
+
+当前span经contextvars随协程传递。未调用open()时所有函数直接返回，几乎没有开销
+"""
+import os
+import json
+import time
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from loguru import logger
+
+from typing import Callable, Dict, Iterator, Optional
+
+
+class Span:
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'start', '_start', 'duration', 'attributes', 'error')
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str] = None,
+                 attributes: Optional[Dict] = None) -> None:
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.time()
+        self._start = time.monotonic()
+        self.duration: Optional[float] = None
+        self.attributes = attributes if attributes is not None else {}
+        self.error: Optional[str] = None
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self._start
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, key: str, value: float):
+        self.attributes[key] = self.attributes.get(key, 0) + value
+
+    def to_dict(self) -> Dict:
+        return {'trace_id': self.trace_id, 'span_id': self.span_id, 'parent_id': self.parent_id,
+                'name': self.name, 'start': round(self.start, 6), 'duration': self.duration,
+                'attributes': self.attributes, 'error': self.error}
+
+
+_current: ContextVar[Optional[Span]] = ContextVar('t2b_current_span', default=None)
+
+
+class Tracer:
+    def __init__(self) -> None:
+        self.enabled = False
+        self.sample_rate = 1.0
+        self.flush_interval = 5.0
+        self._file = None
+        self._last_flush = time.monotonic()
+        self.stats = {'traces': 0, 'spans': 0}
+
+    def open(self, path: str, sample_rate: float = 1.0, flush_interval: float = 5):
+        """
+        Args:
+            sample_rate (float): 追踪的推文比例
+        """
+        self.close()
+        self._file = open(path, 'a', encoding='utf-8')
+        self.sample_rate = sample_rate
+        self.flush_interval = flush_interval
+        self.enabled = True
+        logger.info(f'Writing tweet traces to {path}, sample rate {sample_rate}')
+
+    def close(self):
+        self.enabled = False
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @staticmethod
+    def current() -> Optional[Span]:
+        return _current.get()
+
+    def start_trace(self, name: str, **attributes) -> Optional[Span]:
+        """
+        开始一个trace，返回其根span，没有开启或者没有被抽中时返回None。根span需要用end结束
+        """
+        if not self.enabled or (self.sample_rate < 1 and random.random() >= self.sample_rate):
+            return None
+        self.stats['traces'] += 1
+        return Span(name, os.urandom(16).hex(), attributes=attributes)
+
+    def end(self, span: Optional[Span], error: Optional[str] = None, **attributes):
+        if span is None or span.duration is not None:
+            return
+        span.duration = round(span.elapsed, 6)
+        span.set(**attributes)
+        if error is not None:
+            span.error = error
+        if self._file is None:
+            return
+        self._file.write(json.dumps(span.to_dict(), ensure_ascii=False, default=str) + '\n')
+        self.stats['spans'] += 1
+        if time.monotonic() - self._last_flush > self.flush_interval:
+            self._file.flush()
+            self._last_flush = time.monotonic()
+
+    @contextmanager
+    def activate(self, span: Optional[Span]) -> Iterator[Optional[Span]]:
+        """
+        把span设为当前span，其中创建的span（包括其中创建的协程任务里的）都是它的子span
+        """
+        token = _current.set(span)
+        try:
+            yield span
+        finally:
+            _current.reset(token)
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Optional[Span]]:
+        """
+        当前span的子span，没有当前span（没有开启或推文没有被抽中）时为None
+        """
+        parent = _current.get()
+        if parent is None:
+            yield None
+            return
+        span = Span(name, parent.trace_id, parent.span_id, attributes)
+        token = _current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            self.end(span, error=f'{type(e).__name__}: {e}')
+            raise
+        else:
+            self.end(span)
+        finally:
+            _current.reset(token)
+
+    def traced(self, name: str) -> Callable:
+        """
+        把协程函数的每次调用记为一个span的装饰器
+        """
+        def decorator(func):
+            @wraps(func)
+            async def wrapped_func(*args, **kwargs):
+                if _current.get() is None:
+                    return await func(*args, **kwargs)
+                with self.span(name):
+                    return await func(*args, **kwargs)
+            return wrapped_func
+        return decorator
+
+    @staticmethod
+    def annotate(**attributes):
+        """
+        给当前span加上属性
+        """
+        span = _current.get()
+        if span is not None:
+            span.set(**attributes)
+
+    @staticmethod
+    def add(key: str, value: float):
+        """
+        累加当前span的数值属性，如字节数
+        """
+        span = _current.get()
+        if span is not None:
+            span.add(key, value)
+
+
+tracer = Tracer()
@@ -1,14 +1,22 @@
-import aiohttp
-from datetime import datetime
-from pytz import timezone
+from datetime import datetime, tzinfo
+from functools import lru_cache
 
+from .startup import LazyModule
+from .tracing import tracer
 from .twitter_api import TwitterAPI
 from .utils.network import get_session
 
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, Tuple, Union, TYPE_CHECKING
+if TYPE_CHECKING:
+    from .media import MediaFetcher
+
+
+pytz = LazyModule('pytz')
 
 
 class TwitterUser:
+    __slots__ = ('id', 'username', 'nickname')
+
     def __init__(self, id: str, username: str, name: str = None, **kwargs) -> None:
         """
         Args:
@@ -22,6 +30,8 @@ class TwitterUser:
 
 
 class TwitterMedia:
+    __slots__ = ('key', 'type', 'url')
+
     def __init__(self, media_key: str, type: str, url: Optional[str] = None, **kwargs) -> None:
         self.key = media_key
         self.type = type  # 可能为photo, GIF, or video
@@ -30,70 +40,127 @@ class TwitterMedia:
         else:
             self.url = None
 
-    async def get_photo(self) -> bytes:
-        session = get_session()
+    async def get_photo(self, fetcher: Optional['MediaFetcher'] = None) -> bytes:
+        if fetcher is not None:
+            return await fetcher.fetch(self.url)
+        session = get_session('media')
         async with session.get(self.url) as response:
             return await response.read()
 
 
 class TwitterPlace:
-    pass
+    __slots__ = ()
 
 
 class TwitterPoll:
-    pass
+    __slots__ = ()
+
+
+_UNSET = object()
+
+
+@lru_cache(maxsize=None)
+def _get_timezone(time_zone: str) -> tzinfo:
+    return pytz.timezone(time_zone)
 
 
 class Tweet:
+    """
+    推文。只保存API返回的原始数据，作者、引用推文、媒体和时间在第一次访问时才解析
+    """
+    __slots__ = ('data', 'includes', '_author', '_referenced_tweet', '_media',
+                 '_create_time', '_formatted_times')
+
     def __init__(self, id: str, text: str, author_id: Optional[str] = None,
                  created_at: Optional[str] = None, referenced_tweets: Optional[Dict] = None,
                  entities: Optional[Dict] = None, attachments: Optional[Dict] = None,
-                 tweet_includes: Optional[Dict] = None, **kwargs) -> None:
-        self.id = id
-        self.raw_text = text
+                 tweet_includes: Union['TweetIncludes', Dict, None] = None, **kwargs) -> None:
+        if not isinstance(tweet_includes, TweetIncludes):
+            tweet_includes = TweetIncludes(tweet_includes)
+        # 保留原始数据，用于持久化后重建推文
+        self.data: Dict = {key: value for key, value in dict(
+            id=id, text=text, author_id=author_id, created_at=created_at,
+            referenced_tweets=referenced_tweets, entities=entities,
+            attachments=attachments, **kwargs).items() if value is not None}
+        self.includes = tweet_includes
 
-        if tweet_includes is None:
-            tweet_includes = {}
+        self._author = _UNSET
+        self._referenced_tweet = _UNSET
+        self._media: Optional[Dict[str, Optional[TwitterMedia]]] = None
+        self._create_time = _UNSET
+        self._formatted_times: Dict[Tuple[str, str], str] = {}
 
-        if author_id is not None:
-            self.author: Optional[TwitterUser] = self.get_from_includes(
-                tweet_includes, 'users', author_id)
-        else:
-            self.author = None
-        if created_at is not None:
-            self.create_time: Optional[datetime] = self._parse_time(created_at)
-        else:
-            self.create_time = None
+    @property
+    def id(self) -> str:
+        return self.data['id']
 
-        if referenced_tweets is None:
-            self.type: str = 'original'  # 可能为original, retweeted, quoted, replied_to
-            self.referenced_tweet: Optional[Tweet] = None
-        else:
-            self.type = referenced_tweets[0]['type']
-            self.referenced_tweet = self.get_from_includes(
-                tweet_includes, 'tweets', referenced_tweets[0]['id'])
+    @property
+    def raw_text(self) -> str:
+        return self.data['text']
+
+    @property
+    def author(self) -> Optional[TwitterUser]:
+        if self._author is _UNSET:
+            author_id = self.data.get('author_id', None)
+            self._author = None if author_id is None else self.includes.get('users', author_id)
+        return self._author
+
+    @property
+    def create_time(self) -> Optional[datetime]:
+        if self._create_time is _UNSET:
+            created_at = self.data.get('created_at', None)
+            self._create_time = None if created_at is None else self._parse_time(created_at)
+        return self._create_time
+
+    @property
+    def type(self) -> str:
+        # 可能为original, retweeted, quoted, replied_to
+        referenced_tweets = self.data.get('referenced_tweets', None)
+        return 'original' if referenced_tweets is None else referenced_tweets[0]['type']
+
+    @property
+    def referenced_tweet(self) -> Optional['Tweet']:
+        if self._referenced_tweet is _UNSET:
+            referenced_tweets = self.data.get('referenced_tweets', None)
+            self._referenced_tweet = None if referenced_tweets is None else self.includes.get(
+                'tweets', referenced_tweets[0]['id'])
+        return self._referenced_tweet
+
+    @property
+    def entities(self) -> Dict[str, List[Dict]]:
         # entities可能包含的域：annotation、urls、hashtags、mentions、cashtags
-        if entities is not None:
-            self.entities: Dict[str, List[Dict]] = entities
-        else:
-            self.entities = {}
+        return self.data.get('entities', {})
 
-        if attachments is not None:
-            media_keys: List[str] = attachments.get('media_keys', [])
-        else:
-            media_keys = []
-        self.media: Dict[str, Optional[TwitterMedia]] = {mkey: 
-            self.get_from_includes(tweet_includes, 'media', mkey) for mkey in media_keys}
+    @property
+    def media(self) -> Dict[str, Optional[TwitterMedia]]:
+        if self._media is None:
+            media_keys: List[str] = self.data.get('attachments', {}).get('media_keys', [])
+            self._media = {mkey: self.includes.get('media', mkey) for mkey in media_keys}
+        return self._media
+
+    def to_payload(self) -> Dict:
+        return {'data': self.data, 'includes': self.includes.includes}
+
+    @classmethod
+    def from_payload(cls, payload: Dict) -> 'Tweet':
+        return cls(**payload['data'], tweet_includes=payload.get('includes', None))
 
     def _parse_time(self, create_time: str) -> datetime:
-        utc_time = datetime.strptime(create_time, '%Y-%m-%dT%H:%M:%S.%fZ')
-        return utc_time.replace(tzinfo=timezone('utc'))
+        # 推特的时间格式如2021-08-24T12:34:56.000Z，fromisoformat比strptime快得多
+        return datetime.fromisoformat(create_time.replace('Z', '+00:00'))
 
     def get_create_time(self, time_zone: str = 'utc') -> datetime:
         if self.create_time is None:
             return None
         else:
-            return self.create_time.astimezone(tz=timezone(time_zone))
+            return self.create_time.astimezone(tz=_get_timezone(time_zone))
+
+    def format_create_time(self, time_zone: str = 'utc', format: str = '%Y-%m-%d %H:%M:%S') -> Optional[str]:
+        key = (time_zone, format)
+        if key not in self._formatted_times:
+            create_time = self.get_create_time(time_zone)
+            self._formatted_times[key] = None if create_time is None else create_time.strftime(format)
+        return self._formatted_times[key]
 
     def parse_text(self) -> str:
         text = self.raw_text
@@ -113,7 +180,8 @@ class Tweet:
         # 注意上面的处理已经改变串长
         return text
 
-    def get_from_includes(self, includes: Dict[str, List[Dict]], include_type: str, unique_id: str):
+    def get_from_includes(self, includes: Union['TweetIncludes', Dict[str, List[Dict]]],
+                          include_type: str, unique_id: str):
         """
         从推特API返回的includes字典解析出推特对象（推文/用户/媒体等）
 
@@ -121,27 +189,18 @@ class Tweet:
             include_type (str): 推特对象的种类，应为'tweets','users','places','media','polls'之中其一
             unique_id (str): 能唯一确定出推特对象的ID值
         """
-        include_class = {'tweets': Tweet, 'users': TwitterUser, 'media': TwitterMedia,
-                         'places': TwitterPlace, 'polls': TwitterPoll}
-        unique_field = {'tweets': 'id', 'users': 'id', 'media': 'media_key',
-                        'places': 'id', 'polls': 'id'}
-        include_object = None
-        for obj in includes.get(include_type, []):
-            if obj[unique_field[include_type]] == unique_id:
-                include_object = obj.copy()
-        if include_object is None:
-            return None
-        else:
-            if include_type == 'tweets':
-                include_object.update({'tweet_includes': includes})
-            return include_class[include_type](**include_object)
+        if not isinstance(includes, TweetIncludes):
+            includes = TweetIncludes(includes)
+        return includes.get(include_type, unique_id)
 
+    @tracer.traced('retrieve_media')
     async def retrieve_media(self, api: TwitterAPI, update_self: bool = True) -> Dict[str, TwitterMedia]:
         tweet_resp = await api.tweet_lookup(
             tweet_id=self.id,
             query={'expansions': 'attachments.media_keys', 'media.fields': 'type,url'})
         media_data = tweet_resp.get('includes', {}).get('media', {})
         retrived = {data['media_key']: TwitterMedia(**data) for data in media_data}
+        tracer.annotate(tweet_id=self.id, media=len(retrived))
         if update_self:
             self.media.update(retrived)
         return retrived
@@ -163,4 +222,41 @@ class Tweet:
         try:
             return [media_dict[key] for key in media_keys]
         except KeyError as e:
-            raise KeyError(f'media key {e.args[0]} is not included by this tweet')
\ No newline at end of file
+            raise KeyError(f'media key {e.args[0]} is not included by this tweet')
+
+
+class TweetIncludes:
+    """
+    推特API返回的includes的索引。按ID建表一次，构造出的推特对象缓存起来，
+    在同一次响应的所有推文之间共享
+    """
+    __slots__ = ('includes', '_raw', '_objects')
+    UNIQUE_FIELD = {'tweets': 'id', 'users': 'id', 'media': 'media_key',
+                    'places': 'id', 'polls': 'id'}
+    INCLUDE_CLASS = {'tweets': Tweet, 'users': TwitterUser, 'media': TwitterMedia,
+                     'places': TwitterPlace, 'polls': TwitterPoll}
+
+    def __init__(self, includes: Optional[Dict[str, List[Dict]]] = None) -> None:
+        if includes is None:
+            includes = {}
+        self.includes = includes
+        self._raw: Dict[str, Dict[str, Dict]] = {
+            include_type: {obj[self.UNIQUE_FIELD[include_type]]: obj for obj in objects}
+            for include_type, objects in includes.items() if include_type in self.UNIQUE_FIELD}
+        self._objects: Dict[str, Dict[str, object]] = {
+            include_type: {} for include_type in self.UNIQUE_FIELD}
+
+    def get(self, include_type: str, unique_id: str):
+        objects = self._objects[include_type]
+        if unique_id in objects:
+            return objects[unique_id]
+
+        raw = self._raw.get(include_type, {}).get(unique_id, None)
+        if raw is None:
+            return None
+        if include_type == 'tweets':
+            obj = Tweet(**raw, tweet_includes=self)
+        else:
+            obj = self.INCLUDE_CLASS[include_type](**raw)
+        objects[unique_id] = obj
+        return obj
@@ -1,6 +1,6 @@
 from .utils.network import get_session
 
-from typing import Dict, Union, Optional
+from typing import Dict, List, Tuple, Union, Optional
 from aiohttp import ClientTimeout, ClientResponse
 
 
@@ -12,22 +12,29 @@ class TwitterAPIException(BaseException):
 
 class TwitterAPI:
     TWEET_LOOKUP_BASE_URL = 'https://api.twitter.com/2/tweets/'
+    TWEETS_LOOKUP_URL = 'https://api.twitter.com/2/tweets'
+    RECENT_SEARCH_URL = 'https://api.twitter.com/2/tweets/search/recent'
     STREAM_URL = 'https://api.twitter.com/2/tweets/search/stream'
     STREAM_RULES_URL = 'https://api.twitter.com/2/tweets/search/stream/rules'
 
     def __init__(self, bearer_token: str) -> None:
         self.bearer_token = bearer_token
         self._headers = self._make_headers()
+        # url -> (剩余次数, 重置时间的unix时间戳)，来自推特返回的x-rate-limit头
+        self.rate_limits: Dict[str, Tuple[int, int]] = {}
 
     def _make_headers(self) -> Dict:
         headers = {'Authorization': f'Bearer {self.bearer_token}'}
         return headers
 
     async def request(self, method: str, url: str, params: Optional[Dict] = None,
-                      json: Optional[Dict] = None, **kwargs) -> ClientResponse:
-        session = get_session()
+                      json: Optional[Dict] = None, pool: str = 'twitter-api', **kwargs) -> ClientResponse:
+        session = get_session(pool)
         headers = kwargs.pop('headers', self._headers)
         response = await session.request(method, url, params=params, json=json, headers=headers, **kwargs)
+        remaining = response.headers.get('x-rate-limit-remaining', None)
+        if remaining is not None:
+            self.rate_limits[url] = (int(remaining), int(response.headers.get('x-rate-limit-reset', 0)))
 
         if not response.ok:
             data = await response.json()
@@ -45,6 +52,20 @@ class TwitterAPI:
         url = self.TWEET_LOOKUP_BASE_URL + str(tweet_id)
         return await self.request_json('GET', url, params=query)
 
+    async def tweets_lookup(self, tweet_ids: List, query: Dict) -> Dict:
+        # 一次最多100个id
+        params = dict(query, ids=','.join(map(str, tweet_ids)))
+        return await self.request_json('GET', self.TWEETS_LOOKUP_URL, params=params)
+
+    async def search_recent(self, search_query: str, query: Dict, since_id: Optional[str] = None,
+                            next_token: Optional[str] = None, max_results: int = 100) -> Dict:
+        params = dict(query, query=search_query, max_results=max_results)
+        if since_id is not None:
+            params['since_id'] = since_id
+        if next_token is not None:
+            params['next_token'] = next_token
+        return await self.request_json('GET', self.RECENT_SEARCH_URL, params=params)
+
     async def get_stream_rules(self) -> Dict:
         return await self.request_json('GET', self.STREAM_RULES_URL)
 
@@ -54,4 +75,4 @@ class TwitterAPI:
     async def get_filtered_stream(self, query: Dict,
                                   timeout: Union[ClientTimeout, float, None] = None) -> ClientResponse:
         # timeout=None为永不超时
-        return await self.request('GET', self.STREAM_URL, params=query, timeout=timeout)
+        return await self.request('GET', self.STREAM_URL, params=query, pool='stream', timeout=timeout)
@@ -1,36 +1,80 @@
 import asyncio
 import aiohttp
-import atexit
 
-from typing import Dict
+from typing import Dict, Optional, Tuple
 
 
-__session_pool: Dict[asyncio.AbstractEventLoop, aiohttp.ClientSession] = {}
+# 各类流量的连接池设置：
+# stream为常驻的filtered stream长连接，不设读超时（由ConnectionSupervisor检测卡死）；
+# media为pbs.twimg.com的图片下载，突发并发高；twitter-api为推特REST接口
+DEFAULT_POOLS: Dict[str, Dict] = {
+    'default': {},
+    'stream': {
+        'limit': 2, 'keepalive_timeout': None, 'ttl_dns_cache': 300,
+        'timeout': aiohttp.ClientTimeout(total=None, connect=30)},
+    'media': {
+        'limit': 32, 'limit_per_host': 16, 'keepalive_timeout': 30, 'ttl_dns_cache': 300,
+        'timeout': aiohttp.ClientTimeout(total=120, connect=10, sock_read=30)},
+    'twitter-api': {
+        'limit': 16, 'limit_per_host': 16, 'keepalive_timeout': 60, 'ttl_dns_cache': 300,
+        'timeout': aiohttp.ClientTimeout(total=30, connect=10)},
+}
 
 
-@atexit.register
-def __clean():
-    async def clean_session():
-        await asyncio.gather(*[session.close() for session in __session_pool.values()])
+class SessionManager:
+    """
+    按名字管理多个aiohttp.ClientSession，每个session有独立的连接池、超时、DNS缓存和keep-alive设置，
+    不同类型的流量互不抢占连接。session在第一次使用时创建，由close()统一关闭
+    """
 
-    loop = asyncio.get_event_loop()
-    if loop.is_closed():
-        loop.run_until_complete(clean_session())
-    else:
-        loop.create_task(clean_session())
+    def __init__(self, pools: Optional[Dict[str, Dict]] = None) -> None:
+        self.pools: Dict[str, Dict] = {name: dict(options) for name, options in DEFAULT_POOLS.items()}
+        if pools is not None:
+            self.configure(pools)
+        self._sessions: Dict[str, Tuple[asyncio.AbstractEventLoop, aiohttp.ClientSession]] = {}
 
+    def configure(self, pools: Dict[str, Dict]):
+        """
+        更新连接池设置，timeout可以是秒数或aiohttp.ClientTimeout，只对之后新建的session生效
+        """
+        for name, options in pools.items():
+            options = dict(options)
+            if isinstance(options.get('timeout', None), (int, float)):
+                options['timeout'] = aiohttp.ClientTimeout(total=options['timeout'])
+            self.pools.setdefault(name, {}).update(options)
 
-def get_session() -> aiohttp.ClientSession:
-    loop = asyncio.get_event_loop()
-    session = __session_pool.get(loop, None)
-    if session is None or session.closed:
-        session = aiohttp.ClientSession(
-            loop=loop, connector=aiohttp.TCPConnector(verify_ssl=False))
-        __session_pool[loop] = session
+    def _create(self, name: str) -> aiohttp.ClientSession:
+        options = dict(self.pools.get(name, self.pools['default']))
+        timeout = options.pop('timeout', aiohttp.ClientTimeout(total=5 * 60))
+        # keepalive_timeout为None时不复用连接
+        if 'keepalive_timeout' in options and options['keepalive_timeout'] is None:
+            options.pop('keepalive_timeout')
+            options['force_close'] = True
+        connector = aiohttp.TCPConnector(ssl=False, **options)
+        return aiohttp.ClientSession(connector=connector, timeout=timeout)
 
-    return session
+    def get(self, name: str = 'default') -> aiohttp.ClientSession:
+        loop = asyncio.get_event_loop()
+        entry = self._sessions.get(name, None)
+        if entry is None or entry[0] is not loop or entry[1].closed:
+            entry = self._sessions[name] = (loop, self._create(name))
+        return entry[1]
 
+    def set(self, session: aiohttp.ClientSession, name: str = 'default'):
+        self._sessions[name] = (asyncio.get_event_loop(), session)
 
-def set_session(session: aiohttp.ClientSession):
-    loop = asyncio.get_event_loop()
-    __session_pool[loop] = session
+    async def close(self):
+        sessions = [session for _, session in self._sessions.values()]
+        self._sessions.clear()
+        await asyncio.gather(*[session.close() for session in sessions if not session.closed])
+
+
+session_manager = SessionManager()
+
+
+def get_session(pool: str = 'default') -> aiohttp.ClientSession:
+    return session_manager.get(pool)
+
+
+def set_session(session: aiohttp.ClientSession, pool: str = 'default'):
+    session_manager.set(session, pool)